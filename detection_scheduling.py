@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Adaptive detection scheduling. Rather than running the detector on a fixed
+frame_num % det_step schedule, Detection_Scheduler starts a detection burst
+(init_frames consecutive detector frames) when tracking needs it: tracked
+positions have grown uncertain, the localizer has lost confidence in many
+objects, new objects are likely to have entered the scene, or too long has
+passed since the last detection. Bursts are never closer than min_interval
+frames nor further apart than max_interval, and the reason for each is logged.
+"""
+
+import numpy as np
+import torch
+
+
+class Detection_Scheduler(object):
+    def __init__(self,min_interval = 3,max_interval = 30,init_frames = 3,
+                 uncertainty_threshold = 0.5,conf_threshold = 4,conf_fraction = 0.25,
+                 entry_threshold = 1.0,entry_margin = 0.1,entry_zones = None,verbose = False):
+        """
+        min_interval,max_interval - fewest and most frames between detection bursts
+        init_frames - consecutive frames processed by the detector in each burst
+        uncertainty_threshold - detect when mean position uncertainty of tracked
+                     objects (KF position std relative to object scale) exceeds this
+        conf_threshold,conf_fraction - detect when more than conf_fraction of
+                     localized objects have localizer confidence (highest_conf)
+                     below conf_threshold
+        entry_threshold - detect when the expected number of objects to have
+                     entered the scene since the last burst reaches this
+        entry_margin - width of the frame border, relative to frame size, in
+                     which new objects are counted as entering
+        entry_zones - (optional) list of xmin,ymin,xmax,ymax regions in which new
+                     objects are counted as entering, instead of the frame border
+        verbose - print the reason for each detection burst
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.init_frames = init_frames
+        self.uncertainty_threshold = uncertainty_threshold
+        self.conf_threshold = conf_threshold
+        self.conf_fraction = conf_fraction
+        self.entry_threshold = entry_threshold
+        self.entry_margin = entry_margin
+        self.entry_zones = entry_zones
+        self.verbose = verbose
+
+        self.last_burst = -np.inf # frame_num at which the last burst started
+        self.burst_end = -np.inf  # first frame_num after the last burst
+        self.interval = None      # frames between the last two bursts
+        self.entries = 0          # objects entering, found by the last burst
+        self.entry_rate = 0       # running average of objects entering per frame
+        self.log = []             # (frame_num, reason, signals) for every burst
+
+    def signals(self,kf,lifecycle):
+        """
+        Returns dict of mean position uncertainty of tracked objects and the
+        fraction of localized objects with low localizer confidence. Objects
+        not measured since they were first detected still have the initial
+        covariance and are left out of the uncertainty
+        """
+        if len(lifecycle) == 0:
+            return {"uncertainty":0.0,"low_conf":0.0}
+
+        # measured since first detection (by detector or localizer)
+        updated = lifecycle.fslm < lifecycle.age
+        if updated.any():
+            rows = updated.to(kf.X.device)
+            scale = kf.X[rows,2].abs().clamp(min = 1)
+            uncertainty = (torch.sqrt(kf.P[rows,0,0] + kf.P[rows,1,1]) / scale).mean().item()
+        else:
+            uncertainty = 0.0
+
+        # objects not yet localized have no confidence
+        localized = lifecycle.fsld > lifecycle.fslm
+        if localized.any():
+            low_conf = (lifecycle.conf[localized] < self.conf_threshold).float().mean().item()
+        else:
+            low_conf = 0.0
+        return {"uncertainty":uncertainty,"low_conf":low_conf}
+
+    def reason(self,frame_num,kf,lifecycle):
+        """
+        Returns the reason to start a detection burst on frame frame_num, or None
+        """
+        since = frame_num - self.last_burst
+        if since < self.min_interval:
+            return None
+        if self.last_burst == -np.inf:
+            return "start"
+        if since >= self.max_interval:
+            return "max_interval"
+
+        signals = self.signals(kf,lifecycle)
+        if signals["uncertainty"] > self.uncertainty_threshold:
+            return "uncertainty"
+        if signals["low_conf"] > self.conf_fraction:
+            return "confidence"
+        if self.entry_rate * since >= self.entry_threshold:
+            return "entry"
+        return None
+
+    def detect_frame(self,frame_num,kf,lifecycle):
+        """
+        Returns True if frame frame_num is processed with the detector, either
+        within a burst or because a new burst is triggered
+        """
+        if self.last_burst <= frame_num < self.burst_end:
+            return True
+
+        reason = self.reason(frame_num,kf,lifecycle)
+        if reason is None:
+            return False
+
+        if self.last_burst != -np.inf:
+            self.interval = frame_num - self.last_burst
+        self.last_burst = frame_num
+        self.burst_end = frame_num + self.init_frames
+
+        self.log.append((frame_num,reason,self.signals(kf,lifecycle)))
+        if self.verbose:
+            print("Detection on frame {}: {}".format(frame_num,reason))
+        return True
+
+    def in_entry_zone(self,boxes,dim):
+        """
+        Returns boolean array, True for each xysr box centered in an entry zone
+        dim - (width, height) of the frame
+        """
+        x,y = boxes[:,0],boxes[:,1]
+        if self.entry_zones is None:
+            w,h = dim
+            return ((x < self.entry_margin*w) | (x > (1-self.entry_margin)*w) |
+                    (y < self.entry_margin*h) | (y > (1-self.entry_margin)*h))
+
+        inside = np.zeros(len(boxes),dtype = bool)
+        for xmin,ymin,xmax,ymax in self.entry_zones:
+            inside |= (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        return inside
+
+    def detected(self,frame_num,new_boxes,dim):
+        """
+        Records objects newly added on a detector frame, updating the rate at
+        which objects enter the scene once each burst is over
+        new_boxes - n x 4 array or tensor of xysr boxes of newly added objects
+        dim - (width, height) of the frame
+        """
+        if torch.is_tensor(new_boxes):
+            new_boxes = new_boxes.cpu().numpy()
+        if frame_num == self.last_burst:
+            self.entries = 0
+        if len(new_boxes) > 0:
+            self.entries += int(self.in_entry_zone(new_boxes,dim).sum())
+
+        # objects found by a burst entered over the frames since the previous one
+        if frame_num == self.burst_end - 1 and self.interval is not None:
+            self.entry_rate = 0.8 * self.entry_rate + 0.2 * self.entries / self.interval
+
+    def summary(self):
+        """
+        Returns number of detection bursts triggered for each reason
+        """
+        counts = {}
+        for frame_num,reason,signals in self.log:
+            counts[reason] = counts.get(reason,0) + 1
+        return counts
+
+
+if __name__ == "__main__":
+    """
+    Checks that a single newly detected object among established tracks does
+    not trigger a detection burst
+    """
+    from torch_kf import Torch_KF
+    from track_lifecycle import Track_Lifecycle
+
+    kf = Torch_KF("cpu")
+    lifecycle = Track_Lifecycle("cpu")
+    scheduler = Detection_Scheduler(min_interval = 3,max_interval = 30)
+
+    # 9 objects detected on a 3 frame burst starting at frame 0
+    boxes = np.stack([np.arange(9)*60 + 50.0,np.full(9,100.0),np.full(9,40.0),np.full(9,0.6)],axis = 1)
+    ids = list(range(9))
+    for frame_num in range(3):
+        assert scheduler.detect_frame(frame_num,kf,lifecycle)
+        if frame_num == 0:
+            kf.add(boxes,ids)
+            lifecycle.add(ids)
+        else:
+            kf.predict()
+            kf.update(boxes,ids)
+            lifecycle.increment(ids)
+        lifecycle.step()
+
+    # a new object first detected on the last frame of the burst
+    kf.add(np.array([[600.0,300.0,40.0,0.6]]),[9])
+    lifecycle.add([9])
+
+    kf.predict()
+    lifecycle.increment()
+    lifecycle.step()
+    reason = scheduler.reason(3,kf,lifecycle)
+    print("Signals with one new track: {}".format(scheduler.signals(kf,lifecycle)))
+    assert reason is None, "one new track triggered a burst ({})".format(reason)
+    print("OK")
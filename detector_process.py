@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Detector server in a dedicated worker process, so the YOLOv3 forward pass
+doesn't compete with the localizer and tracker bookkeeping for the GIL or for
+intra-op threads. Frames are handed to the worker through a ring of
+fixed-size slots in shared memory; only slot indices and frame shapes are sent
+over the request queue, never frame pixels. The worker detects each request's
+frames in one batch and sends back the (small) detection arrays. Torch thread
+counts are set separately for the worker and the calling process.
+"""
+
+import os
+import time
+import queue
+import threading
+import numpy as np
+import torch
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from frame_sources import Frame
+import model_registry
+
+
+def _detector_worker(factory,factory_args,shm_name,slot_shape,n_slots,n_threads,requests,results):
+    """
+    Worker process loop: reads frames from the shared ring, detects each
+    request's frames as one batch and returns per-frame detections
+    """
+    torch.set_num_threads(n_threads)
+    shm = shared_memory.SharedMemory(name = shm_name)
+    try:
+        ring = np.ndarray((n_slots,) + tuple(slot_shape),dtype = np.uint8,buffer = shm.buf)
+        try:
+            detector = factory(*factory_args)
+        except Exception as e:
+            results.put((None,"Detector failed to load: {!r}".format(e)))
+            return
+        results.put((None,None)) # ready
+
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            request_id,items = request
+            try:
+                frames = [Frame(ring[slot,:h,:w]) for slot,h,w in items]
+                inputs = [frame.detector_input("cpu") for frame in frames]
+                ims = torch.cat([im for im,dim in inputs])
+                dims = torch.cat([dim for im,dim in inputs])
+                with torch.no_grad():
+                    detections = detector.detect2(ims,dims).cpu()
+                # first column of detector output is index of the frame within the batch
+                output = [detections[detections[:,0] == i].numpy() for i in range(len(items))]
+                results.put((request_id,output))
+            except Exception as e:
+                results.put((request_id,"Detection failed: {!r}".format(e)))
+    finally:
+        del ring
+        shm.close()
+
+
+class Detector_Process(object):
+    """
+    Runs a detector in a worker process fed through a shared-memory frame ring.
+    Use as a context manager, or call start() and close()
+    """
+
+    def __init__(self,factory = model_registry.get_detector,factory_args = ("cpu",),
+                 frame_shape = (540,960),n_slots = 8,detector_threads = None,
+                 tracker_threads = None,start_method = "spawn"):
+        """
+        factory,factory_args - picklable callable and arguments that build the
+                     detector in the worker, by default the YOLOv3 Darknet_Detector
+                     on cpu from model_registry
+        frame_shape - (height, width) of the largest frame that will be passed
+        n_slots - frames in the shared ring, i.e. most frames per request in flight
+        detector_threads,tracker_threads - torch intra-op threads for the worker
+                     and for this process. By default cores are split evenly
+        start_method - multiprocessing start method; spawn avoids forking a
+                     process whose torch thread pools are already running
+        """
+        n_cores = os.cpu_count() or 1
+        self.factory = factory
+        self.factory_args = tuple(factory_args)
+        self.slot_shape = (frame_shape[0],frame_shape[1],3)
+        self.n_slots = n_slots
+        self.detector_threads = detector_threads if detector_threads is not None else max(1,n_cores // 2)
+        self.tracker_threads = tracker_threads if tracker_threads is not None else max(1,n_cores - self.detector_threads)
+        self.context = mp.get_context(start_method)
+
+        self.shm = None
+        self.ring = None
+        self.process = None
+        self.caller_threads = None # this process's thread count before start()
+        self.next_request = 0
+        self.lock = threading.Lock() # one request in flight, the ring is shared between them
+        self.detect_time = 0 # wall time spent waiting for the worker
+
+    def start(self,timeout = 300):
+        """
+        Starts the worker and waits until its detector is loaded
+        """
+        size = self.n_slots * int(np.prod(self.slot_shape))
+        self.shm = shared_memory.SharedMemory(create = True,size = size)
+        self.ring = np.ndarray((self.n_slots,) + self.slot_shape,dtype = np.uint8,buffer = self.shm.buf)
+        self.requests = self.context.Queue()
+        self.results = self.context.Queue()
+        self.process = self.context.Process(target = _detector_worker,daemon = True,
+                                            args = (self.factory,self.factory_args,self.shm.name,
+                                                    self.slot_shape,self.n_slots,self.detector_threads,
+                                                    self.requests,self.results))
+        self.process.start()
+        self.caller_threads = torch.get_num_threads()
+        torch.set_num_threads(self.tracker_threads)
+
+        try:
+            request_id,error = self._get(timeout)
+        except Exception:
+            self.close()
+            raise
+        if error is not None:
+            self.close()
+            raise RuntimeError(error)
+        return self
+
+    def close(self):
+        """
+        Stops the worker, releases the shared ring and restores this process's
+        thread count
+        """
+        if self.process is not None:
+            if self.process.is_alive():
+                self.requests.put(None)
+                self.process.join(timeout = 10)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+        if self.shm is not None:
+            self.ring = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+        if self.caller_threads is not None:
+            torch.set_num_threads(self.caller_threads)
+            self.caller_threads = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*args):
+        self.close()
+
+    def _get(self,timeout = None):
+        """
+        Returns the next result from the worker, raising if the worker dies
+        """
+        start = time.time()
+        while True:
+            try:
+                return self.results.get(timeout = 1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("Detector process exited with code {}".format(self.process.exitcode))
+                if timeout is not None and time.time() - start > timeout:
+                    raise TimeoutError("No response from detector process after {}s".format(timeout))
+
+    def detect_frames(self,frames):
+        """
+        Detects frames in the worker, one batch per n_slots frames
+        frames - list of Frame or H x W x 3 uint8 RGB arrays
+        returns - list of detector output (tensor) for each frame, in order
+        """
+        if self.process is None:
+            raise RuntimeError("Detector process is not running, call start() first")
+        start = time.time()
+        with self.lock:
+            output = self._detect_frames(frames)
+        self.detect_time += time.time() - start
+        return output
+
+    def _detect_frames(self,frames):
+        output = []
+        for first in range(0,len(frames),self.n_slots):
+            items = []
+            for slot,frame in enumerate(frames[first:first + self.n_slots]):
+                im = frame.im if isinstance(frame,Frame) else frame
+                h,w = im.shape[:2]
+                if h > self.slot_shape[0] or w > self.slot_shape[1]:
+                    raise ValueError("Frame of size {}x{} exceeds detector process frame_shape {}".format(
+                            h,w,self.slot_shape[:2]))
+                self.ring[slot,:h,:w] = im
+                items.append((slot,h,w))
+
+            # the whole ring is reused once this request's results are back
+            request_id = self.next_request
+            self.next_request += 1
+            self.requests.put((request_id,items))
+            # results of earlier requests whose caller was interrupted
+            # (e.g. by KeyboardInterrupt) before collecting them are discarded
+            result_id,result = self._get()
+            while result_id != request_id:
+                result_id,result = self._get()
+            if isinstance(result,str):
+                raise RuntimeError(result)
+            output += [torch.from_numpy(detections) for detections in result]
+        return output
+
+
+if __name__ == "__main__":
+    """
+    Compares tracking with the detector in-process and in a worker process
+    on one sequence, for a few thread splits
+    """
+    from torch_kf import Torch_KF
+    import track_utils
+
+    track_dir = "/home/worklab/Desktop/detrac/DETRAC-all-data/MVI_20011"
+    n_cores = os.cpu_count() or 1
+
+    preds,Hz,time_metrics = track_utils.skip_track(track_dir,Torch_KF("cpu"),det_step = 5,PLOT = False)
+    print("In-process detector: {:.2f} fps".format(Hz))
+
+    for detector_threads in sorted(set([1,n_cores // 2,n_cores - 1])):
+        if detector_threads < 1 or detector_threads >= n_cores:
+            continue
+        with Detector_Process(detector_threads = detector_threads,
+                              tracker_threads = n_cores - detector_threads) as detector:
+            preds,Hz,time_metrics = track_utils.skip_track(track_dir,Torch_KF("cpu"),det_step = 5,
+                                                           PLOT = False,detector = detector)
+        print("Detector process with {} of {} threads: {:.2f} fps".format(detector_threads,n_cores,Hz))
@@ -108,12 +108,89 @@ class ResNet_Localizer(nn.Module):
         
         return cls_out,reg_out
 
+class Student_Localizer(nn.Module):
+    """
+    Lightweight localizer with a MobileNet or ShuffleNet feature extractor and
+    the same classification and regression heads (and (cls_out,reg_out)
+    outputs) as ResNet_Localizer, trained by distillation from it
+    """
+    
+    backbones = {
+        "mobilenet_v2":models.mobilenet_v2,
+        "mobilenet_v3_small":models.mobilenet_v3_small,
+        "shufflenet_v2_x0_5":models.shufflenet_v2_x0_5,
+        "shufflenet_v2_x1_0":models.shufflenet_v2_x1_0
+        }
+    
+    def __init__(self,backbone = "mobilenet_v3_small",pretrained = True):
+        super(Student_Localizer, self).__init__()
+        
+        self.backbone = backbone
+        self.feat = self.backbones[backbone](pretrained = pretrained)
+        
+        # all backbones end in a 1000-way imagenet layer, as resnet18 does
+        start_num = 1000
+        mid_num = int(np.sqrt(start_num))
+        
+        self.classifier = nn.Sequential(
+                          nn.Linear(start_num,mid_num,bias=True),
+                          nn.ReLU(),
+                          nn.Linear(mid_num,13,bias = True)
+                          )
+        self.regressor = nn.Sequential(
+                          nn.Linear(start_num,mid_num,bias=True),
+                          nn.ReLU(),
+                          nn.Linear(mid_num,4,bias = True),
+                          nn.ReLU()
+                          )
+        
+        for layer in list(self.classifier) + list(self.regressor):
+            if type(layer) == torch.nn.modules.linear.Linear:
+                init_val = 0.05
+                nn.init.uniform_(layer.weight.data,-init_val,init_val)
+                nn.init.uniform_(layer.bias.data,-init_val,init_val)
+    
+    def forward(self, x):
+        features = self.feat(x)
+        cls_out = self.classifier(features)
+        reg_out = self.regressor(features)
+        return cls_out,reg_out
+
+class Distillation_Loss(nn.Module):
+    """
+    Matches student outputs to teacher outputs: KL divergence between 
+    temperature-softened class distributions, and MSE between box regressions
+    """
+    def __init__(self,temperature = 4.0,reg_weight = 1.0):
+        super(Distillation_Loss,self).__init__()
+        self.temperature = temperature
+        self.reg_weight = reg_weight
+        
+    def forward(self,cls_out,reg_out,teacher_cls,teacher_reg):
+        T = self.temperature
+        # T^2 keeps gradient magnitude independent of temperature
+        cls_loss = nn.functional.kl_div(nn.functional.log_softmax(cls_out/T,dim = 1),
+                                        nn.functional.softmax(teacher_cls/T,dim = 1),
+                                        reduction = "batchmean") * T * T
+        reg_loss = nn.functional.mse_loss(reg_out,teacher_reg)
+        return cls_loss + self.reg_weight * reg_loss
+
+def _backbone(model):
+    return getattr(getattr(model,"module",model),"backbone","resnet18")
+
 def train_model(model, optimizer, scheduler,losses,
                     dataloaders,device, patience= 10, start_epoch = 0,
-                    all_metrics = None):
+                    all_metrics = None, teacher = None, distill_loss = None,
+                    resolutions = None):
         """
         Alternates between a training step and a validation step at each epoch. 
         Validation results are reported but don't impact model weights
+        teacher - (optional) trained localizer to distill from. If given, 
+                  distill_loss between model and teacher outputs is added
+                  to the loss on labels
+        resolutions - (optional) list of input sizes. If given, each training
+                  batch is resized to one of them at random so the model
+                  learns to localize at several crop resolutions
         """
         max_epochs = 500
         
@@ -146,6 +223,12 @@ def train_model(model, optimizer, scheduler,losses,
                     inputs = inputs.to(device)
                     targets = targets.to(device)
                     
+                    # box targets are relative to the crop, so they hold at any size
+                    if resolutions is not None and phase == 'train':
+                        size = random.choice(resolutions)
+                        inputs = nn.functional.interpolate(inputs,size = (size,size),
+                                                           mode = "bilinear",align_corners = False)
+                    
                     # zero the parameter gradients
                     optimizer.zero_grad()
     
@@ -168,6 +251,16 @@ def train_model(model, optimizer, scheduler,losses,
                                 if phase == 'train':
                                     loss_comp.backward(retain_graph = True)
                                 each_loss.append(round(loss_comp.item()*100000)/100000.0)
+                            
+                            # match teacher outputs
+                            if teacher is not None:
+                                with torch.no_grad():
+                                    teacher_cls,teacher_reg = teacher(inputs)
+                                loss_comp = distill_loss(cls_out.float(),reg_out.float(),
+                                                         teacher_cls.float(),teacher_reg.float())
+                                if phase == 'train':
+                                    loss_comp.backward(retain_graph = True)
+                                each_loss.append(round(loss_comp.item()*100000)/100000.0)
                                 
                             # apply each cls loss function
                             cls_targets = targets[:,4]
@@ -200,9 +293,10 @@ def train_model(model, optimizer, scheduler,losses,
                         avg_loss = total_loss/count
                         if avg_loss < best_loss:
                             # save a checkpoint
-                            PATH = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2/resnet18_epoch{}_batch{}.pt".format(epoch,count)
+                            PATH = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2/{}_epoch{}_batch{}.pt".format(_backbone(model),epoch,count)
                             torch.save({
                                 'epoch': epoch,
+                                'backbone': _backbone(model),
                                 'model_state_dict': model.state_dict(),
                                 'optimizer_state_dict': optimizer.state_dict(),
                                 "metrics": all_metrics
@@ -220,9 +314,10 @@ def train_model(model, optimizer, scheduler,losses,
 
                 if avg_loss < best_loss:
                     # save a checkpoint
-                    PATH = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2/resnet18_epoch{}_end.pt".format(epoch)
+                    PATH = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2/{}_epoch{}_end.pt".format(_backbone(model),epoch)
                     torch.save({
                         'epoch': epoch,
+                        'backbone': _backbone(model),
                         'model_state_dict': model.state_dict(),
                         'optimizer_state_dict': optimizer.state_dict(),
                         "metrics": all_metrics
@@ -270,7 +365,7 @@ class Box_Loss(nn.Module):
         maxx,_ = torch.min(torch.cat((output[:,2].unsqueeze(1),target[:,2].unsqueeze(1)),1),1)
         maxy,_ = torch.min(torch.cat((output[:,3].unsqueeze(1),target[:,3].unsqueeze(1)),1),1)
 
-        zeros = torch.zeros(minx.shape).unsqueeze(1).to(device)
+        zeros = torch.zeros(minx.shape).unsqueeze(1).to(output.device)
         delx,_ = torch.max(torch.cat(((maxx-minx).unsqueeze(1),zeros),1),1)
         dely,_ = torch.max(torch.cat(((maxy-miny).unsqueeze(1),zeros),1),1)
         intersection = torch.mul(delx,dely)
@@ -370,10 +465,12 @@ def move_dual_checkpoint_to_cpu(model,optimizer,checkpoint):
     for key in model.state_dict():
         new_state_dict[key.split("module.")[-1]] = model.state_dict()[key]
     
-    new_checkpoint = checkpoint.split("resnet")[0] + "cpu_resnet18_epoch{}.pt".format(epoch)
+    backbone = _backbone(model)
+    new_checkpoint = checkpoint.split(backbone)[0] + "cpu_{}_epoch{}.pt".format(backbone,epoch)
     
     torch.save({
         'epoch': epoch,
+        'backbone': backbone,
         'model_state_dict': new_state_dict,
         'optimizer_state_dict': optimizer.state_dict(),
         "metrics": all_metrics
@@ -419,6 +516,16 @@ if __name__ == "__main__":
     #checkpoint_file = None
 
     patience = 4
+    
+    # distillation mode trains a small student localizer from a trained ResNet_Localizer teacher
+    DISTILL = False
+    student_backbone = "mobilenet_v3_small"
+    teacher_checkpoint = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2/cpu_resnet18_epoch14.pt"
+    if DISTILL:
+        checkpoint_file = None
+    
+    # fine-tune for multi-resolution crops (e.g. [96,160,224]) for Tracker crop_sizes
+    resolutions = None
 
     label_dir       = "/home/worklab/Desktop/detrac/DETRAC-Train-Annotations-XML-v3"
     train_image_dir = "/home/worklab/Desktop/detrac/DETRAC-train-data"
@@ -442,12 +549,24 @@ if __name__ == "__main__":
     try:
         model
     except:
-        model = ResNet_Localizer()
+        if DISTILL:
+            model = Student_Localizer(student_backbone)
+        else:
+            model = ResNet_Localizer()
         if MULTI:
             model = nn.DataParallel(model,device_ids = [0,1])
     model = model.to(device)
     print("Loaded model.")
     
+    teacher = None
+    distill_loss = None
+    if DISTILL:
+        teacher = ResNet_Localizer()
+        teacher.load_state_dict(torch.load(teacher_checkpoint)['model_state_dict'])
+        teacher = teacher.to(device).eval()
+        distill_loss = Distillation_Loss(temperature = 4.0)
+        print("Loaded teacher.")
+    
     
     # 3. create training params
     params = {'batch_size' : 32,
@@ -505,7 +624,10 @@ if __name__ == "__main__":
                             device,
                             patience = patience,
                             start_epoch = start_epoch+1,
-                            all_metrics = all_metrics)
+                            all_metrics = all_metrics,
+                            teacher = teacher,
+                            distill_loss = distill_loss,
+                            resolutions = resolutions)
         
     # try plotting
     batch = next(iter(dataloaders['val']))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel image decoding for frame ingestion. A Decode_Pool decodes image files
+with a configurable backend (PIL, OpenCV's cv2.imdecode or libjpeg-turbo via
+PyTurboJPEG when installed) on a pool of threads or processes, and hands the
+results back in submission order. It also records how long decoding takes so
+sustained decode throughput can be compared against tracker throughput.
+"""
+
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import cv2
+from PIL import Image
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
+
+BACKENDS = ["pil","cv2","turbojpeg"]
+
+# TurboJPEG handle, created once per worker process
+_turbo = None
+
+
+def decode_image(path,backend = "cv2"):
+    """
+    Decodes the image at path
+    backend - one of "pil", "cv2" or "turbojpeg"
+    returns - H x W x 3 uint8 RGB array
+    """
+    global _turbo
+
+    if backend == "pil":
+        with Image.open(path) as im:
+            return np.array(im.convert("RGB"))
+
+    with open(path,"rb") as f:
+        data = f.read()
+
+    if backend == "turbojpeg":
+        if TurboJPEG is None:
+            raise ImportError("turbojpeg backend requires PyTurboJPEG and libjpeg-turbo")
+        if _turbo is None:
+            _turbo = TurboJPEG()
+        return _turbo.decode(data,pixel_format = TJPF_RGB)
+
+    elif backend == "cv2":
+        im = cv2.imdecode(np.frombuffer(data,dtype = np.uint8),cv2.IMREAD_COLOR)
+        if im is None:
+            raise IOError("Could not decode {}".format(path))
+        return cv2.cvtColor(im,cv2.COLOR_BGR2RGB)
+
+    else:
+        raise ValueError("Unknown decode backend {}, expected one of {}".format(backend,BACKENDS))
+
+def _decode_job(path,backend,transform,extra):
+    """
+    Runs in a worker. Decodes one image, then applies transform(im,extra) if given
+    returns - (result, seconds spent decoding)
+    """
+    start = time.time()
+    im = decode_image(path,backend)
+    decode_time = time.time() - start
+    if transform is not None:
+        im = transform(im,extra)
+    return im,decode_time
+
+
+class Decode_Pool(object):
+    """
+    Decodes images on n_workers threads or processes and yields them in order
+    """
+
+    def __init__(self,n_workers = 4,backend = "cv2",executor = "thread"):
+        """
+        n_workers - number of decode workers
+        backend - one of "pil", "cv2" or "turbojpeg"
+        executor - "thread" (cv2, turbojpeg and PIL all release the GIL while
+                   decoding) or "process" (results are pickled back to the caller)
+        """
+        if backend not in BACKENDS:
+            raise ValueError("Unknown decode backend {}, expected one of {}".format(backend,BACKENDS))
+        if executor not in ["thread","process"]:
+            raise ValueError("Unknown executor {}, expected thread or process".format(executor))
+
+        self.n_workers = max(1,n_workers)
+        self.backend = backend
+        self.executor = executor
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n_decoded = 0          # frames decoded
+        self.decode_time = 0        # summed per-frame decode time across workers
+        self.wall_time = 0          # wall clock time from first submit to last frame yielded
+        self.stall_time = 0         # time the consumer spent waiting on decodes
+
+    def stats(self):
+        """
+        Returns dict of decode statistics
+        fps - frames delivered per wall clock second (bounded by the consumer)
+        capacity_fps - sustained decode rate with all workers busy
+        stall_time - seconds the consumer waited for frames; if this is a 
+                     large share of wall_time, decoding is the bottleneck
+        """
+        return {
+            "frames":self.n_decoded,
+            "fps":self.n_decoded / self.wall_time if self.wall_time > 0 else 0,
+            "capacity_fps":self.n_workers * self.n_decoded / self.decode_time if self.decode_time > 0 else 0,
+            "wall_time":self.wall_time,
+            "stall_time":self.stall_time,
+            "workers":self.n_workers,
+            "backend":self.backend,
+            "executor":self.executor
+            }
+
+    def imap(self,paths,extras = None,transform = None,queue_depth = 8):
+        """
+        Generator yielding transform(decode(paths[i]),extras[i]) in order
+        paths - list of image paths
+        extras - (optional) list of per-image arguments for transform
+        transform - (optional) function applied in the worker after decoding;
+                    must be picklable (module level) for the process executor
+        queue_depth - maximum number of decoded results held ahead of the consumer
+        """
+        if extras is None:
+            extras = [None] * len(paths)
+        queue_depth = max(1,queue_depth)
+
+        if self.executor == "process":
+            pool = ProcessPoolExecutor(max_workers = self.n_workers)
+        else:
+            pool = ThreadPoolExecutor(max_workers = self.n_workers)
+
+        pending = deque()
+        self._start = time.time()
+        try:
+            for path,extra in zip(paths,extras):
+                pending.append(pool.submit(_decode_job,path,self.backend,transform,extra))
+
+                # only yield once the prefetch queue is full, so workers stay ahead
+                if len(pending) >= queue_depth:
+                    yield self._collect(pending.popleft())
+            while len(pending) > 0:
+                yield self._collect(pending.popleft())
+        finally:
+            # consumer stopped early, don't decode frames nobody will use
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait = False)
+
+    def _collect(self,future):
+        start = time.time()
+        result,decode_time = future.result()
+        self.stall_time += time.time() - start
+        self.wall_time = time.time() - self._start
+        self.n_decoded += 1
+        self.decode_time += decode_time
+        return result
+
+
+if __name__ == "__main__":
+    """
+    Compares sustained decode throughput of each backend and worker count on one sequence
+    """
+    import os
+
+    track_directory = "/home/worklab/Desktop/detrac/DETRAC-all-data/MVI_20011"
+    paths = sorted([os.path.join(track_directory,im) for im in os.listdir(track_directory)])
+
+    for backend in BACKENDS:
+        if backend == "turbojpeg" and TurboJPEG is None:
+            continue
+        for n_workers in [1,2,4,8]:
+            pool = Decode_Pool(n_workers = n_workers,backend = backend)
+            for im in pool.imap(paths,queue_depth = 2*n_workers):
+                pass
+            stats = pool.stats()
+            print("{} with {} workers: {:.1f} fps ({:.1f} fps capacity)".format(backend,n_workers,stats["fps"],stats["capacity_fps"]))
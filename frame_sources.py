@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frame sources for the tracker. Rather than decoding a whole sequence into
+memory before tracking starts, a source decodes frames lazily in background
+workers, keeps at most queue_depth decoded frames waiting, and yields them in
+order as Frame objects. Memory is O(queue depth) and tracking starts as soon
+as the first frame is ready.
+
+Each Frame is stored once as uint8. The detector's resized input, normalized
+regions for the localizer and the BGR copy used for plotting are all derived
+on demand, so normalization only touches pixels that are actually cropped.
+
+For repeated experiments on the same sequences, Cached_Sequence_Source reads
+frames from a one-time packed, memory-mapped uint8 conversion of the sequence
+instead of decoding JPEGs on every run. Video_Source reads video containers
+(mp4/mkv) directly with OpenCV or a local ffmpeg process.
+"""
+
+import os
+import json
+import time
+import queue
+import hashlib
+import threading
+import subprocess
+import numpy as np
+
+import cv2
+import torch
+from torchvision.ops import roi_align
+
+from frame_decode import Decode_Pool
+
+
+def list_frames(track_directory):
+    """
+    Returns sorted list of paths to all frames in track_directory
+    """
+    files = [os.path.join(track_directory,im) for im in os.listdir(track_directory)]
+    files.sort()
+    return files
+
+# imagenet statistics the localizer was trained with
+MEAN = [0.485, 0.456, 0.406]
+STD  = [0.229, 0.224, 0.225]
+
+
+class Frame(object):
+    """
+    A single decoded frame, kept once as an H x W x 3 uint8 RGB array
+    """
+
+    def __init__(self,im,frame_num = None):
+        self.im = im
+        self.frame_num = frame_num
+        self._tensors = {}  # uint8 tensor copies keyed by device
+
+    @property
+    def dim(self):
+        """ (width, height) of the frame """
+        return (self.im.shape[1],self.im.shape[0])
+
+    def bgr(self):
+        """
+        Returns BGR view of the frame for plotting with cv2
+        """
+        return self.im[:,:,::-1]
+
+    def tensor(self,device):
+        """
+        Returns 3 x H x W uint8 tensor of the frame on device, uploaded once
+        """
+        key = str(device)
+        if key not in self._tensors:
+            self._tensors[key] = torch.from_numpy(self.im).to(device,non_blocking = True).permute(2,0,1)
+        return self._tensors[key]
+
+    def detector_input(self,device,resolution = 1024):
+        """
+        Returns (im, dim) as expected by Darknet_Detector.detect2, where im is
+        a 1 x 3 x resolution x resolution float tensor in [0,1] and dim holds
+        the original frame size
+        """
+        im = cv2.resize(self.im,(resolution,resolution))
+        im = torch.from_numpy(im).to(device,non_blocking = True)
+        im = im.permute(2,0,1).float().div(255.0).unsqueeze(0).contiguous()
+        dim = torch.FloatTensor(self.dim).repeat(1,2).to(device)
+        return im,dim
+
+    def localizer_crops(self,device,crop_boxes,mask_boxes = None,occluders = None,size = 224):
+        """
+        Returns N x 3 x size x size float crops of the frame, normalized as
+        expected by the localizer. Only the region covered by the crops is
+        converted, and normalization and masking are applied to the crops
+        rather than the frame
+        crop_boxes - N x 4 array of crop boxes (xmin,ymin,xmax,ymax)
+        mask_boxes - (optional) N x 4 array of object boxes (xmin,ymin,xmax,ymax).
+                     If given, the boxes of all other objects are blanked in
+                     each object's crop
+        occluders - (optional) M x 4 array of all object boxes to blank, if
+                    crops are only made for some of the objects (defaults to mask_boxes)
+        """
+        crop_boxes = np.asarray(crop_boxes,dtype = float)
+        
+        # union of all crops, plus a pixel for bilinear interpolation
+        width,height = self.dim
+        x0 = int(np.clip(np.floor(crop_boxes[:,0].min()) - 1,0,width - 1))
+        y0 = int(np.clip(np.floor(crop_boxes[:,1].min()) - 1,0,height - 1))
+        x1 = int(np.clip(np.ceil(crop_boxes[:,2].max()) + 2,x0 + 1,width))
+        y1 = int(np.clip(np.ceil(crop_boxes[:,3].max()) + 2,y0 + 1,height))
+        region = self.tensor(device)[:,y0:y1,x0:x1].float().div(255.0)
+        h,w = region.shape[1:]
+        
+        # crops are aligned from the raw region together with a coverage plane
+        # (samples falling outside the frame are zero after normalization) and
+        # an occupancy plane of all object boxes
+        planes = [region,torch.ones([1,h,w],device = device)]
+        if mask_boxes is not None:
+            if occluders is None:
+                occluders = mask_boxes
+            rects = np.clip(np.asarray(occluders) - [x0,y0,x0,y0],0,None).astype(int)
+            planes.append(_occupancy(rects,h,w,device))
+            rects = np.clip(np.asarray(mask_boxes) - [x0,y0,x0,y0],0,None).astype(int)
+        
+        rois = torch.zeros([len(crop_boxes),5])
+        rois[:,1:] = torch.from_numpy(crop_boxes - [x0,y0,x0,y0]).float()
+        rois = rois.to(device)
+        aligned = roi_align(torch.cat(planes).unsqueeze(0),rois,(size,size))
+        
+        mean = torch.tensor(MEAN,device = device).view(1,3,1,1)
+        scale = 1.0 / torch.tensor(STD,device = device).view(1,3,1,1)
+        
+        if mask_boxes is not None:
+            # region coordinates of crop pixel centers; region pixel k covers [k - 0.5, k + 0.5)
+            u = (torch.arange(size,device = device).float() + 0.5) / size
+            xs = rois[:,1:2] + u * (rois[:,3:4] - rois[:,1:2])
+            ys = rois[:,2:3] + u * (rois[:,4:5] - rois[:,2:3])
+            rects = torch.from_numpy(rects).float().to(device) - 0.5
+            own_x = (xs >= rects[:,0:1]) & (xs < rects[:,2:3])
+            own_y = (ys >= rects[:,1:2]) & (ys < rects[:,3:4])
+            own = own_y.unsqueeze(2) & own_x.unsqueeze(1)
+            
+            # each crop keeps its own object's box and blanks every other box
+            keep = torch.where(own,torch.ones_like(aligned[:,4]),1 - aligned[:,4])
+            scale = scale * keep.unsqueeze(1)
+        
+        # roi_align is linear, so normalizing crops matches normalizing the region
+        return (aligned[:,:3] - mean * aligned[:,3:4]) * scale
+
+def _occupancy(rects,h,w,device):
+    """
+    Returns 1 x h x w float plane that is 1 inside any of the integer rects
+    (xmin,ymin,xmax,ymax) and 0 elsewhere, drawn with a 2D difference array
+    rather than one slice assignment per rect
+    """
+    rects = torch.from_numpy(rects).long().to(device)
+    rects[:,[0,2]] = rects[:,[0,2]].clamp(max = w)
+    rects[:,[1,3]] = rects[:,[1,3]].clamp(max = h)
+    rects = rects[(rects[:,2] > rects[:,0]) & (rects[:,3] > rects[:,1])]
+    
+    diff = torch.zeros([h+1,w+1],device = device)
+    ones = torch.ones(len(rects),device = device)
+    diff.index_put_((rects[:,1],rects[:,0]),ones,accumulate = True)
+    diff.index_put_((rects[:,1],rects[:,2]),-ones,accumulate = True)
+    diff.index_put_((rects[:,3],rects[:,0]),-ones,accumulate = True)
+    diff.index_put_((rects[:,3],rects[:,2]),ones,accumulate = True)
+    counts = diff.cumsum(0).cumsum(1)[:h,:w]
+    return (counts > 0.5).float().unsqueeze(0)
+
+def _to_frame(im,frame_num):
+    return Frame(im,frame_num)
+
+
+class Image_Directory_Source(object):
+    """
+    Streams the frames of a directory of images (e.g. a DETRAC MVI_xxxxx
+    sequence) in order, decoding up to queue_depth frames ahead of the
+    consumer on a Decode_Pool
+    """
+
+    def __init__(self,track_directory,queue_depth = 8,n_workers = 2,
+                 backend = "cv2",executor = "thread",cutoff = None):
+        """
+        queue_depth - maximum number of decoded frames held ahead of the consumer
+        n_workers,backend,executor - decode pool settings, see Decode_Pool
+        cutoff - (optional) stop after frame cutoff + 1
+        """
+        self.queue_depth = max(1,queue_depth)
+        self.pool = Decode_Pool(n_workers = n_workers,backend = backend,executor = executor)
+
+        self.files = list_frames(track_directory)
+        if cutoff is not None:
+            self.files = self.files[:cutoff + 2]
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return self.pool.imap(self.files,list(range(len(self.files))),transform = _to_frame,
+                              queue_depth = self.queue_depth)
+
+    def stats(self):
+        """
+        Returns decode throughput statistics, see Decode_Pool.stats()
+        """
+        return self.pool.stats()
+
+
+#------------------------- preprocessed sequence cache ------------------------#
+CACHE_VERSION = 1
+
+
+def _file_record(path,old_records = {}):
+    """
+    Returns name, size, mtime and content sha1 of path. The content hash is
+    reused from old_records if size and mtime are unchanged
+    """
+    name = os.path.basename(path)
+    stat = os.stat(path)
+    old = old_records.get(name)
+    if old is not None and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns:
+        digest = old["sha1"]
+    else:
+        with open(path,"rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    return {"name":name,"size":stat.st_size,"mtime_ns":stat.st_mtime_ns,"sha1":digest}
+
+def _fingerprint(records):
+    h = hashlib.sha1()
+    for rec in records:
+        h.update("{}:{}\n".format(rec["name"],rec["sha1"]).encode())
+    return h.hexdigest()
+
+def _frame_number(path):
+    digits = "".join([c for c in os.path.splitext(os.path.basename(path))[0] if c.isdigit()])
+    return int(digits) if len(digits) > 0 else -1
+
+def build_sequence_cache(track_directory,cache_directory,n_workers = 4,backend = "cv2"):
+    """
+    Decodes every frame of track_directory once and packs them into a single
+    uint8 file (frames.u8) in cache_directory, alongside an index (index.json)
+    of frame shapes, byte offsets, frame numbers and a content fingerprint of
+    the source images
+    """
+    os.makedirs(cache_directory,exist_ok = True)
+    files = list_frames(track_directory)
+    records = [_file_record(f) for f in files]
+
+    shapes = []
+    offsets = []
+    offset = 0
+    data_path = os.path.join(cache_directory,"frames.u8")
+    pool = Decode_Pool(n_workers = n_workers,backend = backend)
+    with open(data_path + ".tmp","wb") as f:
+        for im in pool.imap(files,queue_depth = 2*n_workers):
+            im = np.ascontiguousarray(im,dtype = np.uint8)
+            f.write(im.tobytes())
+            shapes.append(list(im.shape))
+            offsets.append(offset)
+            offset += im.nbytes
+
+    index = {
+        "version":CACHE_VERSION,
+        "source":os.path.abspath(track_directory),
+        "fingerprint":_fingerprint(records),
+        "files":records,
+        "frame_numbers":[_frame_number(f) for f in files],
+        "shapes":shapes,
+        "offsets":offsets
+        }
+    index_path = os.path.join(cache_directory,"index.json")
+    with open(index_path + ".tmp","w") as f:
+        json.dump(index,f)
+
+    # swap in atomically so an interrupted build never looks valid
+    os.replace(data_path + ".tmp",data_path)
+    os.replace(index_path + ".tmp",index_path)
+    return index
+
+def load_cache_index(track_directory,cache_directory):
+    """
+    Returns the cache index if cache_directory holds an up to date cache of
+    track_directory, otherwise None
+    """
+    index_path = os.path.join(cache_directory,"index.json")
+    if not os.path.exists(index_path) or not os.path.exists(os.path.join(cache_directory,"frames.u8")):
+        return None
+    with open(index_path,"r") as f:
+        index = json.load(f)
+    if index.get("version") != CACHE_VERSION:
+        return None
+
+    # only files whose size or mtime changed are re-hashed
+    old_records = {rec["name"]:rec for rec in index["files"]}
+    records = [_file_record(f,old_records) for f in list_frames(track_directory)]
+    if _fingerprint(records) != index["fingerprint"]:
+        return None
+    return index
+
+
+class Cached_Sequence_Source(object):
+    """
+    Streams the frames of a sequence from a memory-mapped cache built by
+    build_sequence_cache, so repeated runs over the same sequence skip JPEG
+    decoding entirely. Each Frame wraps a zero-copy view of the mapped file.
+    The cache is (re)built on first use or whenever the source images change
+    """
+
+    def __init__(self,track_directory,cache_root,n_workers = 4,backend = "cv2",cutoff = None):
+        """
+        cache_root - directory holding one cache subdirectory per sequence
+        n_workers,backend - decode settings used if the cache must be built
+        cutoff - (optional) stop after frame cutoff + 1
+        """
+        track_directory = os.path.normpath(track_directory)
+        self.cache_directory = os.path.join(cache_root,os.path.basename(track_directory))
+
+        index = load_cache_index(track_directory,self.cache_directory)
+        if index is None:
+            print("Building frame cache for {}".format(track_directory))
+            index = build_sequence_cache(track_directory,self.cache_directory,
+                                         n_workers = n_workers,backend = backend)
+        self.index = index
+        self.n_frames = len(index["offsets"])
+        if cutoff is not None:
+            self.n_frames = min(self.n_frames,cutoff + 2)
+
+        # copy-on-write mapping, so frames are writable views that never modify the cache
+        self.data = np.memmap(os.path.join(self.cache_directory,"frames.u8"),dtype = np.uint8,mode = "c")
+
+    def __len__(self):
+        return self.n_frames
+
+    def frame_number(self,i):
+        """ Returns the frame number parsed from the image name of frame i """
+        return self.index["frame_numbers"][i]
+
+    def __getitem__(self,i):
+        shape = self.index["shapes"][i]
+        offset = self.index["offsets"][i]
+        size = int(np.prod(shape))
+        return Frame(self.data[offset:offset+size].reshape(shape),i)
+
+    def __iter__(self):
+        for i in range(self.n_frames):
+            yield self[i]
+
+
+#-------------------------------- video input ---------------------------------#
+VIDEO_EXTENSIONS = [".mp4",".mkv",".avi",".mov",".ts",".h264",".264"]
+
+
+def is_video(path):
+    """
+    Returns True if path is a video container file rather than a directory of images
+    """
+    return os.path.isfile(path) and os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+
+class Video_Source(object):
+    """
+    Streams the frames of a video file (e.g. H.264 in mp4/mkv) in order,
+    decoding sequentially in a background thread up to queue_depth frames
+    ahead of the consumer. Decoding is done either by OpenCV or by a local
+    ffmpeg process whose raw RGB output is read through a pipe
+    """
+
+    def __init__(self,video_path,backend = "opencv",queue_depth = 8,start_frame = 0,
+                 cutoff = None,ffmpeg = "ffmpeg",ffprobe = "ffprobe"):
+        """
+        backend - "opencv" or "ffmpeg"
+        queue_depth - maximum number of decoded frames held ahead of the consumer
+        start_frame - first frame yielded, see seek()
+        cutoff - (optional) stop after frame cutoff + 1
+        ffmpeg,ffprobe - executables used by the ffmpeg backend
+        """
+        if backend not in ["opencv","ffmpeg"]:
+            raise ValueError("Unknown video backend {}, expected opencv or ffmpeg".format(backend))
+        self.video_path = video_path
+        self.backend = backend
+        self.queue_depth = max(1,queue_depth)
+        self.start_frame = start_frame
+        self.cutoff = cutoff
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+
+        if backend == "ffmpeg":
+            self._probe_ffprobe()
+        else:
+            self._probe_opencv()
+        self.reset_stats()
+
+    def _probe_opencv(self):
+        cap = cv2.VideoCapture(self.video_path)
+        if not cap.isOpened():
+            raise IOError("Could not open video {}".format(self.video_path))
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+        self.total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+    def _probe_ffprobe(self):
+        cmd = [self.ffprobe,"-v","error","-select_streams","v:0",
+               "-show_entries","stream=width,height,avg_frame_rate,nb_frames:format=duration",
+               "-of","json",self.video_path]
+        info = json.loads(subprocess.check_output(cmd))
+        stream = info["streams"][0]
+        self.width = int(stream["width"])
+        self.height = int(stream["height"])
+        num,den = stream["avg_frame_rate"].split("/")
+        self.fps = float(num) / float(den) if float(den) > 0 else 0
+        try:
+            self.total_frames = int(stream["nb_frames"])
+        except (KeyError,ValueError):
+            # some containers (e.g. mkv) don't store a frame count
+            self.total_frames = int(float(info["format"]["duration"]) * self.fps)
+
+    def __len__(self):
+        n_frames = max(0,self.total_frames - self.start_frame)
+        if self.cutoff is not None:
+            n_frames = min(n_frames,self.cutoff + 2)
+        return n_frames
+
+    def seek(self,frame_num):
+        """
+        Sets the first frame yielded by the next iteration, e.g. to start at a
+        detection frame. The ffmpeg backend seeks to the nearest preceding
+        keyframe in the container and decodes forward from there
+        """
+        self.start_frame = frame_num
+
+    def reset_stats(self):
+        self.n_decoded = 0          # frames decoded
+        self.decode_time = 0        # time spent decoding in the background thread
+        self.wall_time = 0          # wall clock time from start of iteration to last frame yielded
+        self.stall_time = 0         # time the consumer spent waiting on decodes
+
+    def stats(self):
+        """
+        Returns dict of decode statistics, as Decode_Pool.stats()
+        """
+        return {
+            "frames":self.n_decoded,
+            "fps":self.n_decoded / self.wall_time if self.wall_time > 0 else 0,
+            "capacity_fps":self.n_decoded / self.decode_time if self.decode_time > 0 else 0,
+            "wall_time":self.wall_time,
+            "stall_time":self.stall_time,
+            "workers":1,
+            "backend":self.backend,
+            "executor":"thread"
+            }
+
+    def _read_opencv(self,stop):
+        cap = cv2.VideoCapture(self.video_path)
+        try:
+            if self.start_frame > 0:
+                cap.set(cv2.CAP_PROP_POS_FRAMES,self.start_frame)
+            while not stop.is_set():
+                start = time.time()
+                ret,im = cap.read()
+                if not ret:
+                    break
+                im = cv2.cvtColor(im,cv2.COLOR_BGR2RGB)
+                self.decode_time += time.time() - start
+                yield im
+        finally:
+            cap.release()
+
+    def _read_ffmpeg(self,stop):
+        cmd = [self.ffmpeg,"-v","error"]
+        if self.start_frame > 0 and self.fps > 0:
+            # input seeking jumps to a keyframe, then decodes accurately to the target
+            cmd += ["-ss","{:.6f}".format(self.start_frame / self.fps)]
+        cmd += ["-i",self.video_path,"-f","rawvideo","-pix_fmt","rgb24","-"]
+        frame_bytes = self.width * self.height * 3
+
+        proc = subprocess.Popen(cmd,stdout = subprocess.PIPE,bufsize = frame_bytes)
+        try:
+            while not stop.is_set():
+                start = time.time()
+                data = proc.stdout.read(frame_bytes)
+                if len(data) < frame_bytes:
+                    break
+                im = np.frombuffer(data,dtype = np.uint8).reshape(self.height,self.width,3)
+                self.decode_time += time.time() - start
+                yield im
+        finally:
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+
+    def _fill(self,frames,stop):
+        """
+        Runs in background thread, decoding frames into the bounded queue frames
+        """
+        reader = self._read_ffmpeg(stop) if self.backend == "ffmpeg" else self._read_opencv(stop)
+        try:
+            for count,im in enumerate(reader):
+                if self.cutoff is not None and count >= self.cutoff + 2:
+                    break
+                while not stop.is_set():
+                    try:
+                        frames.put(im,timeout = 0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            frames.put(e)
+        finally:
+            reader.close()
+            frames.put(None)
+
+    def __iter__(self):
+        frames = queue.Queue(maxsize = self.queue_depth)
+        stop = threading.Event()
+        worker = threading.Thread(target = self._fill,args = (frames,stop),daemon = True)
+        start_time = time.time()
+        worker.start()
+
+        frame_num = self.start_frame
+        try:
+            while True:
+                start = time.time()
+                im = frames.get()
+                self.stall_time += time.time() - start
+                if im is None:
+                    break
+                if isinstance(im,Exception):
+                    raise im
+                self.n_decoded += 1
+                self.wall_time = time.time() - start_time
+                yield Frame(im,frame_num)
+                frame_num += 1
+        finally:
+            # consumer stopped early, stop decoding and release the decoder
+            stop.set()
+            while worker.is_alive():
+                try:
+                    frames.get_nowait()
+                except queue.Empty:
+                    worker.join(timeout = 0.1)
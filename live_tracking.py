@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Live-stream tracking. A capture thread publishes frames into a latest-frame-wins
+buffer as they arrive (from a camera, or from a file replayed at a fixed rate),
+and the tracker always consumes the newest frame. Frames that are overwritten
+before the tracker gets to them, or that are already older than the per-frame
+latency budget when picked up, are dropped, and tracked objects are carried
+across the gap with multi-step Kalman filter prediction. Dropped frame counts
+and end-to-end latency (capture to tracker output) percentiles are reported.
+"""
+
+import time
+import threading
+import numpy as np
+
+import cv2
+
+from frame_sources import Frame
+
+
+class Latest_Frame_Buffer(object):
+    """
+    Single-slot buffer holding only the most recently captured frame. Putting a
+    frame overwrites any frame the consumer has not yet taken
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.item = None
+        self.closed = False
+        self.n_put = 0
+        self.n_overwritten = 0  # frames replaced before the consumer took them
+
+    def put(self,frame,capture_time):
+        with self.cond:
+            if self.item is not None:
+                self.n_overwritten += 1
+            self.item = (frame,capture_time)
+            self.n_put += 1
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def get(self):
+        """
+        Blocks until a frame is available and returns (frame, capture_time),
+        or None once the buffer is closed and empty
+        """
+        with self.cond:
+            while self.item is None and not self.closed:
+                self.cond.wait()
+            item = self.item
+            self.item = None
+            return item
+
+
+class Camera_Source(object):
+    """
+    Iterates frames from a camera index or stream url (e.g. rtsp) via OpenCV
+    """
+
+    def __init__(self,device = 0):
+        self.device = device
+
+    def __iter__(self):
+        cap = cv2.VideoCapture(self.device)
+        if not cap.isOpened():
+            raise IOError("Could not open camera {}".format(self.device))
+        frame_num = 0
+        try:
+            while True:
+                ret,im = cap.read()
+                if not ret:
+                    break
+                yield Frame(cv2.cvtColor(im,cv2.COLOR_BGR2RGB),frame_num)
+                frame_num += 1
+        finally:
+            cap.release()
+
+
+class Live_Source(object):
+    """
+    Runs a capture thread that reads frames from source and publishes each one
+    into a Latest_Frame_Buffer, stamped with its arrival time
+    """
+
+    def __init__(self,source,fps = None):
+        """
+        source - iterable of Frames (Camera_Source, Video_Source, ...)
+        fps - if given, frames are released at this fixed rate to replay a
+              local file as though it were a live feed. Leave as None for
+              sources that are already paced (cameras)
+        """
+        self.source = source
+        self.fps = fps
+        self.buffer = Latest_Frame_Buffer()
+        self.stop = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self._capture,daemon = True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stop.set()
+        self.buffer.close()
+
+    def _capture(self):
+        start_time = time.time()
+        try:
+            for count,frame in enumerate(self.source):
+                if self.stop.is_set():
+                    break
+                if self.fps is not None:
+                    # wait until this frame would have arrived from a real camera
+                    delay = start_time + count / self.fps - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.buffer.put(frame,time.time())
+        finally:
+            self.buffer.close()
+
+    def frames(self):
+        """
+        Yields (frame, frame_index, capture_time) for the newest frame each time
+        the consumer is ready, skipping over frames that were overwritten
+        """
+        while True:
+            item = self.buffer.get()
+            if item is None:
+                return
+            frame,capture_time = item
+            yield frame,frame.frame_num,capture_time
+
+
+def latency_percentiles(latencies,percentiles = [50,90,99]):
+    """
+    Returns dict of latency percentiles in milliseconds
+    """
+    if len(latencies) == 0:
+        return {"p{}".format(p):0 for p in percentiles}
+    values = np.percentile(np.array(latencies) * 1000,percentiles)
+    return {"p{}".format(p):v for p,v in zip(percentiles,values)}
+
+def track_live(tracker,live_source,latency_budget = 0.1,max_frames = None):
+    """
+    Tracks a live feed, always processing the newest available frame. Frames
+    older than latency_budget seconds when picked up are dropped rather than
+    processed, and the tracker predicts through every dropped frame
+    tracker - track_utils.Tracker object
+    live_source - Live_Source (started here if not already running)
+    latency_budget - maximum age in seconds of a frame that is still processed
+    max_frames - (optional) stop after this many source frames
+    returns - final_output (one list of object dicts per source frame) and
+              metrics dict with dropped frame counts and latency percentiles
+    """
+    if live_source.thread is None:
+        live_source.start()
+
+    latencies = []
+    n_processed = 0
+    n_stale = 0
+    start_frame = tracker.frame_num
+
+    try:
+        for frame,index,capture_time in live_source.frames():
+            index = start_frame + index
+            if max_frames is not None and index - start_frame >= max_frames:
+                break
+
+            # too old to be useful, wait for a fresher frame instead
+            if time.time() - capture_time > latency_budget:
+                n_stale += 1
+                continue
+
+            # carry objects across overwritten or stale frames by prediction alone
+            tracker.skip(index - tracker.frame_num)
+            tracker.step(frame)
+            latencies.append(time.time() - capture_time)
+            n_processed += 1
+    finally:
+        live_source.close()
+
+    # frames dropped after the last processed frame are predicted through too
+    n_frames = live_source.buffer.n_put
+    if max_frames is not None:
+        n_frames = min(n_frames,max_frames)
+    tracker.skip(start_frame + n_frames - tracker.frame_num)
+
+    final_output = tracker.flush()
+    metrics = {
+        "processed":n_processed,
+        "dropped":live_source.buffer.n_put - n_processed,
+        "overwritten":live_source.buffer.n_overwritten,
+        "stale":n_stale,
+        "latency_ms":latency_percentiles(latencies)
+        }
+    return final_output,metrics
+
+
+if __name__ == "__main__":
+    """
+    Replays a local video at its native rate as though it were a live camera
+    """
+    import track_utils
+    from torch_kf import Torch_KF
+    from frame_sources import Video_Source
+
+    video_path = "/home/worklab/Desktop/detrac/MVI_20011.mp4"
+    source = Video_Source(video_path)
+    kf = Torch_KF("cpu",mod_err = 1, meas_err = 1, state_err = 0)
+    tracker = track_utils.Tracker(kf,det_step = 15,ber = 2)
+
+    final_output,metrics = track_live(tracker,Live_Source(source,fps = source.fps),latency_budget = 1/source.fps)
+    print("Processed {} frames, dropped {} ({} overwritten, {} stale)".format(
+            metrics["processed"],metrics["dropped"],metrics["overwritten"],metrics["stale"]))
+    print("End-to-end latency: {}".format(metrics["latency_ms"]))
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Inference backends for ResNet_Localizer. The localizer can be exported, with
+its unused embedder head stripped, to a frozen TorchScript module or to an ONNX
+model run with ONNX Runtime on CPU. Every export is checked for numerical
+parity against the eager model before it replaces the deployed artefact, and
+all backends are called the same way, returning (cls_out,reg_out) tensors.
+"""
+
+import os
+import time
+import numpy as np
+import torch
+from torch import nn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+BACKENDS = ["eager","torchscript","onnxruntime"]
+
+
+class Inference_Localizer(nn.Module):
+    """
+    ResNet_Localizer without the embedder head, which tracking never uses
+    """
+
+    def __init__(self,localizer):
+        super(Inference_Localizer,self).__init__()
+        self.feat = localizer.feat
+        self.classifier = localizer.classifier
+        self.regressor = localizer.regressor
+
+    def forward(self,x):
+        features = self.feat(x)
+        return self.classifier(features),self.regressor(features)
+
+
+class ONNX_Localizer(object):
+    """
+    Runs an exported localizer with ONNX Runtime on CPU
+    """
+
+    def __init__(self,onnx_path,n_threads = None):
+        if onnxruntime is None:
+            raise ImportError("onnxruntime backend requires the onnxruntime package")
+        options = onnxruntime.SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        self.session = onnxruntime.InferenceSession(onnx_path,options,providers = ["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self,crops):
+        device = crops.device
+        cls_out,reg_out = self.session.run(None,{self.input_name:crops.detach().cpu().numpy()})
+        return torch.from_numpy(cls_out).to(device),torch.from_numpy(reg_out).to(device)
+
+
+def parity_check(reference,candidate,crop_size = 224,batch_sizes = [1,8,32],atol = 1e-3):
+    """
+    Compares candidate outputs against reference (eager) outputs on random crops
+    returns - dict with the largest absolute cls_out and reg_out differences,
+              and whether both are within atol
+    """
+    generator = torch.Generator().manual_seed(0)
+    cls_err = 0
+    reg_err = 0
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            crops = torch.randn([batch_size,3,crop_size,crop_size],generator = generator)
+            ref_cls,ref_reg = reference(crops)
+            cls_out,reg_out = candidate(crops)
+            cls_err = max(cls_err,(cls_out - ref_cls).abs().max().item())
+            reg_err = max(reg_err,(reg_out - ref_reg).abs().max().item())
+
+    return {"cls_err":cls_err,
+            "reg_err":reg_err,
+            "passed":cls_err <= atol and reg_err <= atol}
+
+def _deploy(tmp_path,path,parity):
+    """
+    Moves an export into place only if it passed the parity check
+    """
+    if not parity["passed"]:
+        os.remove(tmp_path)
+        raise ValueError("Export to {} failed parity check (cls_err {:.2e}, reg_err {:.2e})".format(
+                path,parity["cls_err"],parity["reg_err"]))
+    os.replace(tmp_path,path)
+
+def export_torchscript(localizer,path,crop_size = 224,atol = 1e-3):
+    """
+    Traces and freezes the stripped localizer on CPU and saves it to path
+    returns - parity check results
+    """
+    model = Inference_Localizer(localizer).cpu().eval()
+    example = torch.zeros([1,3,crop_size,crop_size])
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(model,example))
+
+    tmp_path = path + ".tmp"
+    frozen.save(tmp_path)
+    parity = parity_check(model,torch.jit.load(tmp_path),crop_size = crop_size,atol = atol)
+    _deploy(tmp_path,path,parity)
+    return parity
+
+def export_onnx(localizer,path,crop_size = 224,atol = 1e-3,opset = 13):
+    """
+    Exports the stripped localizer to an ONNX model with dynamic batch and crop size
+    returns - parity check results
+    """
+    model = Inference_Localizer(localizer).cpu().eval()
+    example = torch.zeros([1,3,crop_size,crop_size])
+
+    tmp_path = path + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(model,example,tmp_path,
+                          input_names = ["crops"],
+                          output_names = ["cls_out","reg_out"],
+                          dynamic_axes = {"crops":{0:"batch",2:"height",3:"width"},
+                                          "cls_out":{0:"batch"},"reg_out":{0:"batch"}},
+                          opset_version = opset,
+                          dynamo = False)
+    parity = parity_check(model,ONNX_Localizer(tmp_path),crop_size = crop_size,atol = atol)
+    _deploy(tmp_path,path,parity)
+    return parity
+
+def artefact_path(checkpoint,backend):
+    """
+    Returns the path of checkpoint's exported artefact for backend
+    """
+    extension = {"torchscript":".ts","onnxruntime":".onnx"}[backend]
+    return os.path.splitext(checkpoint)[0] + extension
+
+def is_current(path,checkpoint):
+    """
+    Returns True if an export exists at path and is newer than checkpoint
+    """
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(checkpoint)
+
+def load_artefact(path,backend,device = "cpu"):
+    """
+    Loads an exported localizer for the torchscript or onnxruntime backend
+    """
+    if backend not in BACKENDS[1:]:
+        raise ValueError("Unknown localizer backend {}, expected one of {}".format(backend,BACKENDS))
+    if torch.device(device).type != "cpu":
+        raise ValueError("{} localizer backend runs on cpu only".format(backend))
+    if backend == "torchscript":
+        return torch.jit.load(path,map_location = device)
+    return ONNX_Localizer(path)
+
+def load_backend(localizer,checkpoint,backend,device = "cpu"):
+    """
+    Returns localizer run with backend, exporting it next to checkpoint first
+    if no export exists or checkpoint is newer than the export
+    localizer - eager ResNet_Localizer with checkpoint weights loaded
+    """
+    if backend == "eager":
+        return localizer.to(device).eval()
+
+    path = artefact_path(checkpoint,backend)
+    if not is_current(path,checkpoint):
+        if backend == "torchscript":
+            parity = export_torchscript(localizer,path)
+        elif backend == "onnxruntime":
+            parity = export_onnx(localizer,path)
+        else:
+            raise ValueError("Unknown localizer backend {}, expected one of {}".format(backend,BACKENDS))
+        print("Exported localizer to {} (max error {:.2e})".format(path,max(parity["cls_err"],parity["reg_err"])))
+    return load_artefact(path,backend,device)
+
+def benchmark(localizer,batch_sizes = [1,2,4,8,16,32,64,128],crop_size = 224,repeats = 3):
+    """
+    Returns dict of crops per second keyed by batch size
+    """
+    crops_per_sec = {}
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            crops = torch.randn([batch_size,3,crop_size,crop_size])
+            localizer(crops) # warm up
+            times = []
+            for i in range(repeats):
+                start = time.time()
+                localizer(crops)
+                times.append(time.time() - start)
+            crops_per_sec[batch_size] = batch_size / np.median(times)
+    return crops_per_sec
+
+
+if __name__ == "__main__":
+    """
+    Exports the localizer and compares crops/sec of each backend on this host
+    """
+    from model_registry import LOCALIZER_CHECKPOINT, get_localizer
+
+    eager = get_localizer("cpu")
+    backends = {"eager":eager}
+    for backend in ["torchscript","onnxruntime"]:
+        if backend == "onnxruntime" and onnxruntime is None:
+            continue
+        backends[backend] = load_backend(eager,LOCALIZER_CHECKPOINT,backend,"cpu")
+        print("{} parity: {}".format(backend,parity_check(eager,backends[backend])))
+
+    for backend in backends:
+        results = benchmark(backends[backend])
+        print("{}: ".format(backend) + ", ".join(["{}: {:.1f}".format(b,results[b]) for b in results]))
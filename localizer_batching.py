@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chunked localizer batching. Rather than sending every tracked object's crop
+through the localizer in one batch (a memory spike in dense scenes), crops are
+split into chunks of at most chunk_size, where chunk_size is bounded by a
+memory budget and/or a per-chunk latency budget. On CPU the chunk size can
+optionally be autotuned by timing the localizer on this host. For exported
+backends, each chunk is copied into a preallocated fixed-shape input buffer
+(one per power-of-two size), so they only ever see a handful of input shapes.
+Eager modules are run on the crops of each chunk alone.
+"""
+
+import time
+import numpy as np
+import torch
+
+# peak memory per crop relative to its input size, measured for the eager
+# resnet18 localizer, used when activations can't be measured
+ACTIVATION_RATIO = 12
+
+# chunk size used when not autotuning (before memory budget limits)
+DEFAULT_CHUNK_SIZE = 32
+
+# autotuned chunk sizes, keyed by (localizer, device, crop shape, budgets)
+_tuned_chunk_sizes = {}
+
+
+class Chunked_Localizer(object):
+    def __init__(self,localizer,device,chunk_size = None,memory_budget = None,
+                 latency_budget = None,max_chunk = 128,autotune = False,verbose = False):
+        """
+        localizer - model returning (cls_out,reg_out) for a batch of crops
+        device - device localizer is on
+        chunk_size - (optional) fixed chunk size. If None, it is DEFAULT_CHUNK_SIZE
+                     limited by the memory budget for each crop size, or 
+                     autotuned when autotune is set
+        memory_budget - (optional) bytes of input and activation memory one
+                        chunk may use
+        latency_budget - (optional) seconds one chunk may take, enables autotuning
+        max_chunk - largest chunk size considered
+        autotune - time the localizer at each chunk size (CPU only). Call 
+                   warm_up() before tracking so tuning isn't timed as tracking
+        verbose - print tuned chunk sizes
+        """
+        self.localizer = localizer
+        self.device = torch.device(device)
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.latency_budget = latency_budget
+        self.max_chunk = max_chunk
+        self.autotune = autotune or latency_budget is not None
+        self.verbose = verbose
+        # exported backends (TorchScript, ONNX Runtime) are fed fixed-shape
+        # buffers, eager modules gain nothing from padding
+        self.exported = (not isinstance(localizer,torch.nn.Module) or 
+                         isinstance(localizer,torch.jit.ScriptModule))
+        self.chunk_sizes = {} # chunk size for each crop shape
+        self.buffers = {}  # fixed-shape input buffers keyed by shape
+
+    def warm_up(self,crop_shapes):
+        """
+        Chooses chunk sizes for each of crop_shapes ahead of time, so that
+        autotuning doesn't happen on the first localized frame
+        """
+        for crop_shape in crop_shapes:
+            self.chunk_size_for(tuple(crop_shape))
+
+    def chunk_size_for(self,crop_shape):
+        if crop_shape not in self.chunk_sizes:
+            if self.chunk_size is not None:
+                self.chunk_sizes[crop_shape] = self.chunk_size
+            else:
+                self.chunk_sizes[crop_shape] = self.tune(crop_shape)
+        return self.chunk_sizes[crop_shape]
+
+    def __call__(self,crops):
+        """
+        Runs the localizer on all crops, chunk by chunk
+        crops - N x 3 x H x W tensor on device
+        returns - cls_out,reg_out for all N crops, in order
+        """
+        crop_shape = tuple(crops.shape[1:])
+        chunk_size = self.chunk_size_for(crop_shape)
+
+        cls_outs = []
+        reg_outs = []
+        with torch.no_grad():
+            for start in range(0,len(crops),chunk_size):
+                chunk = crops[start:start+chunk_size]
+                n = len(chunk)
+                if self.exported:
+                    buffer = self._buffer(n,crop_shape,chunk_size)
+                    buffer[:n].copy_(chunk)
+                    chunk = buffer
+                cls_out,reg_out = self.localizer(chunk)
+                cls_outs.append(cls_out[:n])
+                reg_outs.append(reg_out[:n])
+
+        if len(cls_outs) == 1:
+            return cls_outs[0],reg_outs[0]
+        return torch.cat(cls_outs),torch.cat(reg_outs)
+
+    def _buffer(self,n,crop_shape,chunk_size):
+        """
+        Returns the smallest fixed-shape buffer (power of two, or chunk_size)
+        holding at least n crops. Rows beyond n hold stale crops, which is
+        harmless since the localizer runs in eval mode
+        """
+        size = min(1 << int(np.ceil(np.log2(n))),chunk_size)
+        shape = (size,) + tuple(crop_shape)
+        if shape not in self.buffers:
+            self.buffers[shape] = torch.zeros(shape,device = self.device)
+        return self.buffers[shape]
+
+    def bytes_per_crop(self,crop_shape):
+        """
+        Estimates peak memory used per crop in a batch as the input plus
+        twice the largest single layer output (the layer's output and the
+        residual or input it is computed from)
+        """
+        sample = torch.zeros((1,) + tuple(crop_shape),device = self.device)
+        input_bytes = sample.numel() * sample.element_size()
+        
+        # exported backends can't be hooked
+        if self.exported:
+            return input_bytes * ACTIVATION_RATIO
+        
+        sizes = []
+        def record(module,inputs,output):
+            outputs = output if isinstance(output,(tuple,list)) else [output]
+            sizes.append(sum(o.numel() * o.element_size() for o in outputs if torch.is_tensor(o)))
+
+        hooks = [m.register_forward_hook(record) for m in self.localizer.modules()
+                 if len(list(m.children())) == 0]
+        try:
+            with torch.no_grad():
+                self.localizer(sample)
+        finally:
+            for hook in hooks:
+                hook.remove()
+
+        largest = max(sizes) if len(sizes) > 0 else 0
+        return input_bytes + 2 * largest
+
+    def tune(self,crop_shape,repeats = 3):
+        """
+        Chooses chunk size: the largest power of two within the memory budget
+        (and DEFAULT_CHUNK_SIZE unless autotuning), and when autotuning on CPU
+        the size with best throughput per crop (within 5%, the smallest such
+        size) that also meets the latency budget
+        """
+        key = (id(self.localizer),str(self.device),tuple(crop_shape),
+               self.memory_budget,self.latency_budget,self.max_chunk,self.autotune)
+        if key in _tuned_chunk_sizes:
+            return _tuned_chunk_sizes[key]
+
+        max_size = self.max_chunk if self.autotune else min(self.max_chunk,DEFAULT_CHUNK_SIZE)
+        if self.memory_budget is not None:
+            max_size = min(max_size,int(self.memory_budget // self.bytes_per_crop(crop_shape)))
+        candidates = [1 << i for i in range(int(np.log2(max(1,max_size))) + 1)]
+
+        if not self.autotune or self.device.type != "cpu":
+            chunk_size = candidates[-1]
+        else:
+            per_crop = {}
+            with torch.no_grad():
+                for size in candidates:
+                    batch = torch.zeros((size,) + tuple(crop_shape),device = self.device)
+                    self.localizer(batch) # warm up
+                    times = []
+                    for i in range(repeats):
+                        start = time.time()
+                        self.localizer(batch)
+                        times.append(time.time() - start)
+                    elapsed = np.median(times)
+                    if self.latency_budget is not None and elapsed > self.latency_budget and size > 1:
+                        break
+                    per_crop[size] = elapsed / size
+
+            best = min(per_crop.values())
+            chunk_size = min(size for size in per_crop if per_crop[size] <= 1.05 * best)
+            if self.verbose:
+                print("Localizer chunk size {} ({:.1f} ms per crop)".format(chunk_size,per_crop[chunk_size]*1000))
+
+        _tuned_chunk_sizes[key] = chunk_size
+        return chunk_size
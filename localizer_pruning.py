@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Structured channel pruning for ResNet_Localizer. The inner channels of every
+residual block of the resnet18 trunk (conv1 outputs, bn1, conv2 inputs) are
+ranked by the magnitude of their BN-scaled filters, and the lowest ranked are
+removed by building smaller dense convolutions, so the pruned localizer runs
+faster with ordinary kernels. Block outputs are left untouched so residual
+connections keep their shape. Pruned checkpoints hold smaller tensors, and
+match_channels shrinks a freshly built localizer to fit them before loading.
+"""
+
+import copy
+import time
+import numpy as np
+import torch
+from torch import nn
+
+
+def residual_blocks(localizer):
+    """
+    Yields (name, BasicBlock) for every residual block of the resnet18 trunk
+    """
+    for layer_name in ["layer1","layer2","layer3","layer4"]:
+        for i,block in enumerate(getattr(localizer.feat,layer_name)):
+            yield "{}.{}".format(layer_name,i),block
+
+def channel_importance(block):
+    """
+    Returns importance of each inner channel of block: the L1 norm of its
+    conv1 filter scaled by the bn1 gain applied to it
+    """
+    bn = block.bn1
+    gain = bn.weight.abs() / torch.sqrt(bn.running_var + bn.eps)
+    return block.conv1.weight.abs().sum(dim = (1,2,3)) * gain
+
+def shrink_block(block,keep):
+    """
+    Replaces block's conv1, bn1 and conv2 with dense layers restricted to the
+    inner channels indexed by keep
+    """
+    keep = torch.as_tensor(keep,dtype = torch.long)
+    conv1,bn1,conv2 = block.conv1,block.bn1,block.conv2
+
+    new_conv1 = nn.Conv2d(conv1.in_channels,len(keep),conv1.kernel_size,stride = conv1.stride,
+                          padding = conv1.padding,bias = False)
+    new_conv1.weight.data = conv1.weight.data[keep].clone()
+
+    new_bn1 = nn.BatchNorm2d(len(keep),eps = bn1.eps,momentum = bn1.momentum)
+    new_bn1.weight.data = bn1.weight.data[keep].clone()
+    new_bn1.bias.data = bn1.bias.data[keep].clone()
+    new_bn1.running_mean = bn1.running_mean[keep].clone()
+    new_bn1.running_var = bn1.running_var[keep].clone()
+
+    new_conv2 = nn.Conv2d(len(keep),conv2.out_channels,conv2.kernel_size,stride = conv2.stride,
+                          padding = conv2.padding,bias = False)
+    new_conv2.weight.data = conv2.weight.data[:,keep].clone()
+
+    device = conv1.weight.device
+    block.conv1 = new_conv1.to(device)
+    block.bn1 = new_bn1.to(device)
+    block.conv2 = new_conv2.to(device)
+
+def prune_localizer(localizer,ratio):
+    """
+    Returns a copy of localizer with the least important fraction ratio of
+    inner channels removed from every residual block
+    """
+    model = copy.deepcopy(localizer)
+    with torch.no_grad():
+        for name,block in residual_blocks(model):
+            n_keep = max(1,int(round(block.conv1.out_channels * (1 - ratio))))
+            keep = torch.argsort(channel_importance(block),descending = True)[:n_keep]
+            shrink_block(block,torch.sort(keep)[0].cpu())
+
+    # names checkpoints saved by train_model
+    model.backbone = "resnet18_pruned{}".format(int(round(ratio*100)))
+    return model
+
+def match_channels(localizer,state_dict):
+    """
+    Shrinks residual blocks of localizer to the inner channel counts stored
+    in state_dict, so a pruned checkpoint can be loaded. Unpruned checkpoints
+    leave localizer unchanged
+    """
+    for name,block in residual_blocks(localizer):
+        n_channels = state_dict["feat.{}.conv1.weight".format(name)].shape[0]
+        if n_channels != block.conv1.out_channels:
+            shrink_block(block,torch.arange(n_channels))
+    return localizer
+
+def count_params(model):
+    """
+    Returns number of parameters, excluding the unused embedder
+    """
+    return sum(p.numel() for name,p in model.named_parameters() if not name.startswith("embedder"))
+
+def count_flops(model,crop_size = 224):
+    """
+    Returns multiply-accumulates of conv and linear layers for one crop,
+    excluding the unused embedder
+    """
+    flops = []
+    def conv_hook(module,inputs,output):
+        kernel = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        flops.append(output.numel() * kernel)
+    def linear_hook(module,inputs,output):
+        flops.append(output.numel() * module.in_features)
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module,nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module,nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+    try:
+        with torch.no_grad():
+            model(torch.zeros([1,3,crop_size,crop_size],device = next(model.parameters()).device))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return sum(flops)
+
+def cpu_latency(model,batch_size = 16,crop_size = 224,repeats = 5):
+    """
+    Returns median seconds per crop on cpu at batch_size
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    crops = torch.randn([batch_size,3,crop_size,crop_size])
+    times = []
+    with torch.no_grad():
+        model(crops) # warm up
+        for i in range(repeats):
+            start = time.time()
+            model(crops)
+            times.append(time.time() - start)
+    return np.median(times) / batch_size
+
+
+if __name__ == "__main__":
+    """
+    Prunes the localizer at several ratios, fine-tunes each with train_model,
+    and reports FLOPs, params, CPU latency and MOTA for each
+    """
+    import os
+    from torch import optim
+    from torch.utils import data
+
+    import mot_eval as mot
+    import track_utils
+    from torch_kf import Torch_KF
+    from model_registry import LOCALIZER_CHECKPOINT, get_localizer
+    from detrac_files.detrac_localization_dataset import Localize_Dataset
+    from detrac_files.detrac_train_localizer import train_model, Box_Loss
+
+    ratios = [0.25,0.5,0.75]
+    patience = 2 # fine-tuning stops after this many epochs without improvement
+
+    label_dir       = "/home/worklab/Desktop/detrac/DETRAC-Train-Annotations-XML-v3"
+    train_image_dir = "/home/worklab/Desktop/detrac/DETRAC-train-data"
+    test_image_dir  = "/home/worklab/Desktop/detrac/DETRAC-test-data"
+    track_dir       = "/home/worklab/Desktop/detrac/DETRAC-all-data"
+    checkpoint_dir  = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2"
+    tracks = [20012,20034,63525,63544,63552]
+
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:0" if use_cuda else "cpu")
+
+    params = {'batch_size' : 32,
+              'shuffle'    : True,
+              'num_workers': 0,
+              'drop_last'  : True
+              }
+    train_data = Localize_Dataset(train_image_dir, label_dir)
+    test_data =  Localize_Dataset(test_image_dir,label_dir)
+    dataloaders = {"train":data.DataLoader(train_data, **params),
+                   "val": data.DataLoader(test_data, **params)}
+    losses = {"cls": [nn.CrossEntropyLoss()],
+              "reg": [nn.MSELoss(), Box_Loss(),]
+              }
+
+    def mota(checkpoint):
+        total = 0
+        for id in tracks:
+            frames = os.path.join(track_dir,"MVI_{}".format(id))
+            labels = os.path.join(label_dir,"MVI_{}_v3.xml".format(id))
+            kf = Torch_KF("cpu",mod_err = 1, meas_err = 1, state_err = 0)
+            preds,Hz,time_metrics = track_utils.skip_track(frames,kf,det_step = 15,ber = 2,
+                                                           PLOT = False,localizer_checkpoint = checkpoint)
+            gts,metadata = mot.parse_labels(labels)
+            metrics,acc = mot.evaluate_mot(preds,gts,metadata['ignored_regions'],threshold = 0.9)
+            total += metrics.to_dict()["mota"][0]
+        return total / len(tracks)
+
+    localizer = get_localizer(device,LOCALIZER_CHECKPOINT)
+    results = {0:{"flops":count_flops(localizer),
+                  "params":count_params(localizer),
+                  "latency":cpu_latency(localizer),
+                  "mota":mota(LOCALIZER_CHECKPOINT)}}
+
+    for ratio in ratios:
+        model = prune_localizer(localizer,ratio).to(device)
+        optimizer = optim.SGD(model.parameters(), lr=0.01,momentum = 0.1)
+        scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=3, gamma=0.3)
+        model,all_metrics = train_model(model,optimizer,scheduler,losses,dataloaders,device,
+                                        patience = patience)
+
+        checkpoint = os.path.join(checkpoint_dir,"cpu_{}.pt".format(model.backbone))
+        torch.save({'backbone':model.backbone,
+                    'model_state_dict':{k:v.cpu() for k,v in model.state_dict().items()}},
+                   checkpoint)
+
+        results[ratio] = {"flops":count_flops(model),
+                          "params":count_params(model),
+                          "latency":cpu_latency(model),
+                          "mota":mota(checkpoint)}
+
+    print("ratio    GFLOPs    params (M)    ms/crop    MOTA")
+    for ratio in results:
+        r = results[ratio]
+        print("{:5.2f}    {:6.3f}    {:10.2f}    {:7.2f}    {:.4f}".format(
+                ratio,r["flops"]/1e9,r["params"]/1e6,r["latency"]*1000,r["mota"]))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Post-training static int8 quantization of ResNet_Localizer for CPU inference.
+The resnet18 trunk is rebuilt as torchvision's quantizable resnet18 with
+conv-bn-relu fused, calibrated on DETRAC crops from Localize_Dataset, and
+converted to int8. The small classifier and regressor heads stay in float.
+Quantized checkpoints store the converted state dict along with the quantized
+engine, and can be passed to model_registry.get_localizer like any other
+localizer checkpoint.
+"""
+
+import time
+import numpy as np
+import torch
+from torch import nn
+from torch.utils import data
+from torchvision.models import quantization as quantizable_models
+
+
+class Quantized_Localizer(nn.Module):
+    """
+    ResNet_Localizer (without the embedder head) built on a quantizable resnet18
+    """
+
+    def __init__(self):
+        super(Quantized_Localizer,self).__init__()
+        self.feat = quantizable_models.resnet18(weights = None,quantize = False)
+
+        start_num = self.feat.fc.out_features
+        mid_num = int(np.sqrt(start_num))
+        self.classifier = nn.Sequential(
+                          nn.Linear(start_num,mid_num,bias=True),
+                          nn.ReLU(),
+                          nn.Linear(mid_num,13,bias = True)
+                          )
+        self.regressor = nn.Sequential(
+                          nn.Linear(start_num,mid_num,bias=True),
+                          nn.ReLU(),
+                          nn.Linear(mid_num,4,bias = True),
+                          nn.ReLU()
+                          )
+
+    def forward(self,x):
+        # the trunk quantizes its input and dequantizes its output
+        features = self.feat(x)
+        return self.classifier(features),self.regressor(features)
+
+
+def _prepare(model,engine):
+    """
+    Fuses conv-bn-relu in the trunk and inserts observers for static quantization
+    """
+    torch.backends.quantized.engine = engine
+    model.eval()
+    model.feat.fuse_model()
+    model.feat.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+    torch.ao.quantization.prepare(model,inplace = True)
+    return model
+
+def quantize_localizer(localizer,calibration_batches,engine = "fbgemm"):
+    """
+    Returns an int8 Quantized_Localizer with the weights of localizer
+    localizer - float ResNet_Localizer
+    calibration_batches - iterable of (inputs,targets) batches of normalized
+                          crops, as returned by a Localize_Dataset loader
+    engine - quantized engine, fbgemm for x86 and qnnpack for arm
+    """
+    model = Quantized_Localizer()
+    state_dict = {key:value for key,value in localizer.state_dict().items()
+                  if not key.startswith("embedder")}
+    model.load_state_dict(state_dict)
+    model = _prepare(model,engine)
+
+    # record activation ranges on real crops
+    with torch.no_grad():
+        for inputs,targets in calibration_batches:
+            model(inputs.cpu())
+
+    torch.ao.quantization.convert(model,inplace = True)
+    return model
+
+def save_quantized(model,path,engine = "fbgemm"):
+    torch.save({
+        "model_state_dict":model.state_dict(),
+        "quantized":engine
+        }, path)
+
+def load_quantized(checkpoint):
+    """
+    Returns the int8 Quantized_Localizer stored in a quantized checkpoint
+    checkpoint - path of, or dict loaded from, a checkpoint saved with save_quantized
+    """
+    if not isinstance(checkpoint,dict):
+        checkpoint = torch.load(checkpoint,map_location = "cpu")
+    engine = checkpoint["quantized"]
+
+    # quantized modules must exist before their packed weights can be loaded
+    model = _prepare(Quantized_Localizer(),engine)
+    torch.ao.quantization.convert(model,inplace = True)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    return model.eval()
+
+def _box_iou(a,b):
+    """
+    Returns iou of each pair of xmin,ymin,xmax,ymax boxes in rows of a and b
+    """
+    minx = torch.max(a[:,0],b[:,0])
+    miny = torch.max(a[:,1],b[:,1])
+    maxx = torch.min(a[:,2],b[:,2])
+    maxy = torch.min(a[:,3],b[:,3])
+    intersection = (maxx - minx).clamp(min = 0) * (maxy - miny).clamp(min = 0)
+    area_a = (a[:,2] - a[:,0]) * (a[:,3] - a[:,1])
+    area_b = (b[:,2] - b[:,0]) * (b[:,3] - b[:,1])
+    return intersection / (area_a + area_b - intersection + 1e-07)
+
+def evaluate(model,batches):
+    """
+    Returns mean box-regression iou, class accuracy and crops per second of
+    model on a list of (inputs,targets) Localize_Dataset batches
+    """
+    # targets are relative to the crop, outputs to a window 3 times crop size
+    imsize = 224
+    wer = 3
+
+    ious = []
+    correct = []
+    elapsed = 0
+    with torch.no_grad():
+        for inputs,targets in batches:
+            start = time.time()
+            cls_out,reg_out = model(inputs)
+            elapsed += time.time() - start
+
+            reg_targets = (targets[:,:4] + imsize*(wer-1)/2) / (imsize*wer)
+            ious.append(_box_iou(reg_out.float(),reg_targets.float()))
+            correct.append(cls_out.argmax(1) == targets[:,4].long())
+
+    n_crops = sum(len(inputs) for inputs,targets in batches)
+    return {"iou":torch.cat(ious).mean().item(),
+            "acc":torch.cat(correct).float().mean().item(),
+            "crops_per_sec":n_crops / elapsed}
+
+
+if __name__ == "__main__":
+    """
+    Calibrates and converts the localizer, then reports int8 vs float
+    throughput and accuracy on held-out DETRAC crops
+    """
+    from detrac_files.detrac_localization_dataset import Localize_Dataset
+    from model_registry import LOCALIZER_CHECKPOINT, QUANTIZED_CHECKPOINT, get_localizer
+
+    label_dir       = "/home/worklab/Desktop/detrac/DETRAC-Train-Annotations-XML-v3"
+    train_image_dir = "/home/worklab/Desktop/detrac/DETRAC-train-data"
+    test_image_dir  = "/home/worklab/Desktop/detrac/DETRAC-test-data"
+    engine = "fbgemm"
+    n_calibration = 32
+    n_test = 32
+
+    params = {'batch_size' : 32,
+              'shuffle'    : True,
+              'num_workers': 0,
+              'drop_last'  : True
+              }
+    calibration_loader = data.DataLoader(Localize_Dataset(train_image_dir,label_dir),**params)
+    test_loader = data.DataLoader(Localize_Dataset(test_image_dir,label_dir),**params)
+
+    # sample crops once so both models see exactly the same (augmented) crops
+    calibration_batches = [batch for batch,i in zip(calibration_loader,range(n_calibration))]
+    test_batches = [batch for batch,i in zip(test_loader,range(n_test))]
+
+    localizer = get_localizer("cpu",LOCALIZER_CHECKPOINT)
+    quantized = quantize_localizer(localizer,calibration_batches,engine = engine)
+    save_quantized(quantized,QUANTIZED_CHECKPOINT,engine = engine)
+
+    float_metrics = evaluate(localizer,test_batches)
+    int8_metrics = evaluate(quantized,test_batches)
+    print("float: {}".format(float_metrics))
+    print("int8:  {}".format(int8_metrics))
+    print("Throughput gain: {:.2f}x, iou change: {:.4f}, accuracy change: {:.4f}".format(
+            int8_metrics["crops_per_sec"] / float_metrics["crops_per_sec"],
+            int8_metrics["iou"] - float_metrics["iou"],
+            int8_metrics["acc"] - float_metrics["acc"]))
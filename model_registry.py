@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of loaded models. The detector and localizer are each
+loaded from disk once per process, keyed by checkpoint path and device, and
+the same instance is handed to every Tracker, so tracking many sequences in a
+loop doesn't re-read YOLOv3 weights and the localizer checkpoint for each one.
+The localizer can optionally be run from a TorchScript or ONNX export saved
+next to its checkpoint, which also skips building ResNet_Localizer (and
+fetching its ImageNet initialization) on cold start, or from an int8 quantized
+checkpoint.
+"""
+
+import os
+import torch
+
+from detrac_files.detrac_train_localizer import ResNet_Localizer, Student_Localizer
+from pytorch_yolo_v3.yolo_detector import Darknet_Detector
+from localizer_backends import load_backend, load_artefact, artefact_path, is_current
+from localizer_quantization import load_quantized
+from localizer_pruning import match_channels
+
+YOLO_CHECKPOINT = "/home/worklab/Desktop/checkpoints/yolo/yolov3.weights"
+LOCALIZER_CHECKPOINT = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2/cpu_resnet18_epoch14.pt"
+QUANTIZED_CHECKPOINT = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2/cpu_resnet18_epoch14_int8.pt"
+
+# loaded models keyed by (kind, checkpoint path, device)
+_models = {}
+
+
+def get_detector(device,checkpoint = YOLO_CHECKPOINT,resolution = 1024):
+    """
+    Returns the shared Darknet_Detector for checkpoint, loading it on first use
+    """
+    key = ("detector",os.path.abspath(checkpoint),str(device),resolution)
+    if key not in _models:
+        _models[key] = Darknet_Detector(
+                'pytorch_yolo_v3/cfg/yolov3.cfg',
+                checkpoint,
+                'pytorch_yolo_v3/data/coco.names',
+                'pytorch_yolo_v3/pallete',
+                resolution = resolution
+                )
+    return _models[key]
+
+def get_localizer(device,checkpoint = LOCALIZER_CHECKPOINT,backend = "eager"):
+    """
+    Returns the shared localizer for checkpoint on device, loading it on first use.
+    Quantized checkpoints (see localizer_quantization) load as int8 models on
+    cpu, distilled student checkpoints as Student_Localizer, and pruned
+    checkpoints (see localizer_pruning) as a narrower ResNet_Localizer
+    backend - "eager", or "torchscript" / "onnxruntime" (cpu only) to run an
+              export saved next to checkpoint, see localizer_backends. The
+              export is created on first use, and again if checkpoint is newer
+    """
+    device = torch.device(device)
+    key = ("localizer",os.path.abspath(checkpoint),str(device),backend)
+    if key in _models:
+        return _models[key]
+
+    if backend != "eager" and is_current(artefact_path(checkpoint,backend),checkpoint):
+        localizer = load_artefact(artefact_path(checkpoint,backend),backend,device)
+    else:
+        cp = torch.load(checkpoint,map_location = device)
+        if "quantized" in cp:
+            if device.type != "cpu":
+                raise ValueError("Quantized localizer {} runs on cpu only".format(checkpoint))
+            localizer = load_quantized(cp)
+        elif cp.get("backbone") in Student_Localizer.backbones:
+            localizer = Student_Localizer(cp["backbone"],pretrained = False)
+            localizer.load_state_dict(cp['model_state_dict'])
+        else:
+            # pruned checkpoints hold fewer channels per residual block
+            localizer = match_channels(ResNet_Localizer(),cp['model_state_dict'])
+            localizer.load_state_dict(cp['model_state_dict'])
+        localizer = load_backend(localizer,checkpoint,backend,device)
+    localizer.eval()
+
+    _models[key] = localizer
+    return localizer
+
+def clear():
+    """
+    Releases all loaded models
+    """
+    _models.clear()
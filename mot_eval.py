@@ -21,6 +21,8 @@ import xml.etree.ElementTree as ET
 import _pickle as pickle
 import matplotlib.pyplot as plt
 
+from spatial_index import grid_pairs, pair_iou
+
 def parse_labels(label_file):
      """
      Returns a set of metadata (1 per track) and a list of labels (1 item per
@@ -178,6 +180,7 @@ def evaluate_mot(preds,gts,ignored_regions = [],threshold = 100):
         # get preds in desired format
         pred = preds[frame]
         pred_ids = [] # object ids for each object in this frame
+        kept_pred = [] # preds not excluded by ignored regions, aligned with pred_ids
         for obj in pred:
             
             #pred object center
@@ -187,6 +190,7 @@ def evaluate_mot(preds,gts,ignored_regions = [],threshold = 100):
             
             if not exclude:
                 pred_ids.append(obj["id"])
+                kept_pred.append(obj)
         pred_ids = np.array(pred_ids)
         
         # get distance matrix in desired format
@@ -200,28 +204,18 @@ def evaluate_mot(preds,gts,ignored_regions = [],threshold = 100):
                     gy = (gt[i]["bbox"][1] + gt[i]['bbox'][3]) /2.0
                     
                     # pred object center
-                    px = (pred[j]["bbox"][0] + pred[j]['bbox'][2]) /2.0
-                    py = (pred[j]["bbox"][1] + pred[j]['bbox'][3]) /2.0
+                    px = (kept_pred[j]["bbox"][0] + kept_pred[j]['bbox'][2]) /2.0
+                    py = (kept_pred[j]["bbox"][1] + kept_pred[j]['bbox'][3]) /2.0
                     
                     d = np.sqrt((px-gx)**2 + (py-gy)**2)
                     dist[i,j] = d
         
-        else: # use iou for matching
+        else: # use iou for matching, only for boxes that actually overlap
             dist = np.ones([len(gt_ids),len(pred_ids)])
-            for i in range(len(gt_ids)):
-                for j in range(len(pred_ids)):
-                    minx = max(gt[i]["bbox"][0],pred[j]["bbox"][0])
-                    maxx = min(gt[i]["bbox"][2],pred[j]["bbox"][2])
-                    miny = max(gt[i]["bbox"][1],pred[j]["bbox"][1])
-                    maxy = min(gt[i]["bbox"][3],pred[j]["bbox"][3])
-                    
-                    intersection = max(0,maxx-minx) * max(0,maxy-miny)
-                    a1 = (gt[i]["bbox"][2] - gt[i]['bbox'][0]) * (gt[i]["bbox"][3] - gt[i]['bbox'][1])
-                    a2 = (pred[j]["bbox"][2] - pred[j]['bbox'][0]) * (pred[j]["bbox"][3] - pred[j]['bbox'][1])
-                    
-                    union = a1+a2-intersection
-                    iou = intersection / union
-                    dist[i,j] = 1-iou
+            gt_boxes = np.array([obj["bbox"] for obj in gt]).reshape(-1,4)
+            pred_boxes = np.array([obj["bbox"] for obj in kept_pred]).reshape(-1,4)
+            pairs = grid_pairs(gt_boxes,pred_boxes)
+            dist[pairs[:,0],pairs[:,1]] = 1 - pair_iou(gt_boxes,pred_boxes,pairs)
             
         # if detection isn't close to any object (> threshold), remove
         # this is a cludgey fix since the detrac dataset doesn't have all of the vehicles labeled
@@ -34,6 +34,13 @@ if __name__ == "__main__":
     #tracks = [63563]
     SHOW = False
     
+    # decoded frames are cached here so repeated runs skip JPEG decoding
+    cache_root = "/home/worklab/Desktop/detrac/DETRAC-frame-cache"
+    
+    # None tracks with the default ResNet_Localizer, or set to a distilled student checkpoint
+    localizer_checkpoint = None
+    #localizer_checkpoint = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2/mobilenet_v3_small_epoch10_end.pt"
+    
     # get list of all files in directory and corresponding path to track and labels
     track_dir = "/home/worklab/Desktop/detrac/DETRAC-all-data"
     label_dir = "/home/worklab/Desktop/detrac/DETRAC-Train-Annotations-XML-v3"
@@ -65,7 +72,9 @@ if __name__ == "__main__":
                                                          det_step = det_step, 
                                                          ber = ber, 
                                                          srr = srr,
-                                                         PLOT = SHOW)
+                                                         PLOT = SHOW,
+                                                         cache_root = cache_root,
+                                                         localizer_checkpoint = localizer_checkpoint)
   
         # get ground truth labels
         gts,metadata = mot.parse_labels(track_dict[id]["labels"])
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Uniform grid spatial index for bounding boxes. Rather than comparing every box
+in one set against every box in another, each box is hashed into the grid cells
+it covers and only boxes that share a cell are returned as candidate pairs. In
+dense scenes nearly all of an N x M IoU matrix is zero, so matching, duplicate
+suppression and evaluation consume these sparse pair lists instead and their
+cost scales with the number of overlapping boxes rather than N x M.
+"""
+
+import numpy as np
+
+
+def xysr_to_xyxy(boxes):
+    """
+    Converts boxes from x_center,y_center,scale,ratio form (width = s,
+    height = s*r) to xmin,ymin,xmax,ymax form
+    boxes - n x (>=4) array or CPU tensor in xysr form
+    returns - n x 4 float array
+    """
+    if len(boxes) == 0:
+        return np.zeros([0,4])
+    boxes = np.asarray(boxes,dtype = float)
+    out = np.zeros([len(boxes),4])
+    out[:,0] = boxes[:,0] - boxes[:,2]/2.0
+    out[:,1] = boxes[:,1] - boxes[:,2]*boxes[:,3]/2.0
+    out[:,2] = boxes[:,0] + boxes[:,2]/2.0
+    out[:,3] = boxes[:,1] + boxes[:,2]*boxes[:,3]/2.0
+    return out
+
+def _cell_entries(boxes,origin,cell_size):
+    """
+    Expands each box into one entry per grid cell it covers
+    returns - (box_idx, cell_x, cell_y) int arrays of equal length
+    """
+    # non-finite boxes can't overlap anything, so park them in cell 0
+    valid = np.isfinite(boxes).all(axis = 1)
+    boxes = np.where(valid[:,None],boxes,origin[[0,1,0,1]])
+    c0 = np.floor((boxes[:,:2] - origin) / cell_size).astype(np.int64)
+    c1 = np.floor((boxes[:,2:] - origin) / cell_size).astype(np.int64)
+
+    # degenerate (negative extent) boxes cover no cells
+    nx = np.maximum(c1[:,0] - c0[:,0] + 1,0)
+    ny = np.maximum(c1[:,1] - c0[:,1] + 1,0)
+    counts = np.where(valid,nx * ny,0)
+
+    box_idx = np.repeat(np.arange(len(boxes)),counts)
+    starts = np.cumsum(counts) - counts
+    offset = np.arange(counts.sum()) - np.repeat(starts,counts)
+    cell_x = c0[box_idx,0] + offset % nx[box_idx]
+    cell_y = c0[box_idx,1] + offset // nx[box_idx]
+    return box_idx,cell_x,cell_y
+
+def grid_pairs(a,b,cell_size = None):
+    """
+    Returns all pairs of boxes (one from a, one from b) with a nonzero
+    intersection, without evaluating all len(a) x len(b) combinations
+    a - n x 4 array of boxes in xmin,ymin,xmax,ymax form
+    b - m x 4 array of boxes in xmin,ymin,xmax,ymax form
+    cell_size - grid cell edge length in pixels, defaults to median box side
+    returns - k x 2 int array where each row is [index into a, index into b]
+    """
+    a = np.asarray(a,dtype = float).reshape(-1,4)
+    b = np.asarray(b,dtype = float).reshape(-1,4)
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros([0,2],dtype = int)
+
+    both = np.concatenate((a,b),axis = 0)
+    if cell_size is None:
+        sides = np.concatenate((both[:,2]-both[:,0],both[:,3]-both[:,1]))
+        sides = sides[np.isfinite(sides) & (sides > 0)]
+        cell_size = np.median(sides) if len(sides) > 0 else 1.0
+    cell_size = max(float(cell_size),1.0)
+    finite = both[np.isfinite(both).all(axis = 1)]
+    origin = finite[:,:2].min(axis = 0) if len(finite) > 0 else np.zeros(2)
+
+    a_idx,ax,ay = _cell_entries(a,origin,cell_size)
+    b_idx,bx,by = _cell_entries(b,origin,cell_size)
+    if len(a_idx) == 0 or len(b_idx) == 0:
+        return np.zeros([0,2],dtype = int)
+
+    # flatten cell coordinates into a single key so cells can be joined by sorting
+    width = max(ax.max(),bx.max()) + 1
+    a_keys = ay * width + ax
+    b_keys = by * width + bx
+    order = np.argsort(b_keys,kind = "stable")
+    b_keys = b_keys[order]
+    b_idx = b_idx[order]
+
+    # for each a entry, the b entries sharing its cell are a contiguous run
+    lo = np.searchsorted(b_keys,a_keys,side = "left")
+    hi = np.searchsorted(b_keys,a_keys,side = "right")
+    run = hi - lo
+    first = np.repeat(a_idx,run)
+    run_starts = np.cumsum(run) - run
+    second = b_idx[np.repeat(lo,run) + np.arange(run.sum()) - np.repeat(run_starts,run)]
+
+    # boxes spanning several shared cells produce duplicate pairs
+    flat = np.unique(first * len(b) + second)
+    pairs = np.stack((flat // len(b),flat % len(b)),axis = 1)
+
+    # sharing a cell does not guarantee overlap, so keep only true intersections
+    inter = _intersection(a[pairs[:,0]],b[pairs[:,1]])
+    return pairs[inter > 0]
+
+def self_pairs(boxes,cell_size = None):
+    """
+    Returns all pairs [i,j] with i < j of mutually overlapping boxes within a
+    single set of xmin,ymin,xmax,ymax boxes
+    """
+    pairs = grid_pairs(boxes,boxes,cell_size = cell_size)
+    return pairs[pairs[:,0] < pairs[:,1]]
+
+def _intersection(a,b):
+    w = np.minimum(a[:,2],b[:,2]) - np.maximum(a[:,0],b[:,0])
+    h = np.minimum(a[:,3],b[:,3]) - np.maximum(a[:,1],b[:,1])
+    return np.maximum(w,0) * np.maximum(h,0)
+
+def pair_iou(a,b,pairs):
+    """
+    Calculates intersection over union only for the listed pairs of boxes
+    a - n x 4 array of boxes in xmin,ymin,xmax,ymax form
+    b - m x 4 array of boxes in xmin,ymin,xmax,ymax form
+    pairs - k x 2 int array of [index into a, index into b]
+    returns - length k float array of ious
+    """
+    if len(pairs) == 0:
+        return np.zeros(0)
+    a = np.asarray(a,dtype = float)[pairs[:,0]]
+    b = np.asarray(b,dtype = float)[pairs[:,1]]
+    inter = _intersection(a,b)
+    area_a = (a[:,2]-a[:,0]) * (a[:,3]-a[:,1])
+    area_b = (b[:,2]-b[:,0]) * (b[:,3]-b[:,1])
+    return inter / (area_a + area_b - inter)
+
+def candidate_pairs(first,second,cell_size = None):
+    """
+    Convenience wrapper returning overlapping pairs and their ious for two
+    sets of boxes in x_center,y_center,scale,ratio form
+    returns - (k x 2 int array of pairs, length k array of ious)
+    """
+    a = xysr_to_xyxy(first)
+    b = xysr_to_xyxy(second)
+    pairs = grid_pairs(a,b,cell_size = cell_size)
+    return pairs, pair_iou(a,b,pairs)
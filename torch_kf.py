@@ -81,6 +81,9 @@ class Torch_KF(object):
         self.mu_Q = self.mu_Q.to(device).float()
         self.mu_R = self.mu_R.to(device).float()
         
+        # multi-step prediction matrices keyed by number of steps
+        self.multistep = {}
+        
         
     def add(self,detections,obj_ids):
         """
@@ -133,10 +136,17 @@ class Torch_KF(object):
                 self.obj_idxs[id] = new_id
                 new_id += 1
     
-    def predict(self):
+    def predict(self,n_steps = 1):
         """
         Uses KF to propagate object locations
+        n_steps - number of frames to propagate by (e.g. when frames are dropped)
         """
+        if n_steps > 1:
+            F_n,Q_n,mu_n = self.multistep_matrices(n_steps)
+            self.X = torch.mm(self.X,F_n.transpose(0,1)) + mu_n
+            self.P = torch.matmul(torch.matmul(F_n,self.P),F_n.transpose(0,1)) + Q_n
+            return
+        
         ### Neeed to figure out whether to invert F for updating
         
         # update X --> X = XF--> [n,7] x [7,7] = [n,7]
@@ -150,6 +160,22 @@ class Torch_KF(object):
         step4 = self.Q.repeat(len(self.P),1,1)
         self.P = step3 + step4
         
+    def multistep_matrices(self,n_steps):
+        """
+        Returns F_n, Q_n and mu_n such that predicting n_steps times is equivalent to
+        X = X F_n^T + mu_n and P = F_n P F_n^T + Q_n. Computed once per n_steps
+        """
+        if n_steps not in self.multistep:
+            F_n = torch.eye(self.state_size,device = self.F.device)
+            Q_n = torch.zeros(self.state_size,self.state_size,device = self.F.device)
+            mu_n = torch.zeros(1,self.state_size,device = self.F.device)
+            for i in range(n_steps):
+                F_n = torch.mm(self.F,F_n)
+                Q_n = torch.mm(torch.mm(self.F,Q_n),self.F.transpose(0,1)) + self.Q[0]
+                mu_n = torch.mm(mu_n,self.F.transpose(0,1)) + self.mu_Q
+            self.multistep[n_steps] = (F_n,Q_n,mu_n)
+        return self.multistep[n_steps]
+        
     def update(self,detections,obj_ids):
         """
         Updates state for objects corresponding to each obj_id in obj_ids
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Struct-of-arrays bookkeeping for the lifecycle of tracked objects (frames since
+last detection and since last measurement, age, class votes and localizer 
+confidence). Row i of every array describes the object stored in row i of
+Torch_KF's X and P, since both append new objects at the end and compact
+removed rows without reordering, so per-frame increments, votes and removals
+are bulk masked tensor operations rather than per-id dictionary updates.
+"""
+
+import torch
+import numpy as np
+
+
+class Track_Lifecycle(object):
+    def __init__(self,device,n_classes = 13):
+        self.device = device
+        self.n_classes = n_classes
+
+        # object ids are handed out in increasing order and rows are never
+        # reordered, so ids stays sorted and slots can be found by binary search
+        self.ids   = torch.zeros(0,dtype = torch.long,device = device)
+        self.fsld  = torch.zeros(0,dtype = torch.long,device = device) # frames since last detected
+        self.fslm  = torch.zeros(0,dtype = torch.long,device = device) # frames since last measured (detected or localized)
+        self.age   = torch.zeros(0,dtype = torch.long,device = device) # frames since first detected
+        self.votes = torch.zeros([0,n_classes],device = device)        # class vote histograms
+        self.conf  = torch.zeros(0,device = device)                    # latest localizer confidence
+
+        # class vote histograms of removed objects, kept for final output
+        self.retired = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def slots(self,obj_ids):
+        """
+        Returns row index of each object id in obj_ids
+        obj_ids - list or tensor of length n of currently tracked ids
+        """
+        obj_ids = torch.as_tensor(obj_ids,dtype = torch.long).to(self.device)
+        return torch.searchsorted(self.ids,obj_ids)
+
+    def add(self,obj_ids):
+        """
+        Appends rows for new objects, in the same order they are added to Torch_KF
+        obj_ids - list of length n with unique, increasing obj_id (int) for each object
+        """
+        n = len(obj_ids)
+        if n == 0:
+            return
+        new_ids = torch.as_tensor(obj_ids,dtype = torch.long).to(self.device)
+
+        self.ids   = torch.cat((self.ids,new_ids))
+        self.fsld  = torch.cat((self.fsld,torch.zeros(n,dtype = torch.long,device = self.device)))
+        self.fslm  = torch.cat((self.fslm,torch.zeros(n,dtype = torch.long,device = self.device)))
+        self.age   = torch.cat((self.age,torch.zeros(n,dtype = torch.long,device = self.device)))
+        self.votes = torch.cat((self.votes,torch.zeros([n,self.n_classes],device = self.device)))
+        self.conf  = torch.cat((self.conf,torch.zeros(n,device = self.device)))
+
+    def remove(self,obj_ids):
+        """
+        Drops rows for each id in obj_ids, preserving order of remaining rows
+        exactly as Torch_KF.remove does
+        """
+        if len(obj_ids) == 0:
+            return
+        keep = torch.ones(len(self.ids),dtype = torch.bool,device = self.device)
+        keep[self.slots(obj_ids)] = False
+
+        gone_ids = self.ids[~keep].tolist()
+        gone_votes = self.votes[~keep].cpu().numpy()
+        for id,votes in zip(gone_ids,gone_votes):
+            self.retired[id] = votes
+
+        self.ids   = self.ids[keep]
+        self.fsld  = self.fsld[keep]
+        self.fslm  = self.fslm[keep]
+        self.age   = self.age[keep]
+        self.votes = self.votes[keep]
+        self.conf  = self.conf[keep]
+
+    def step(self,n_frames = 1):
+        """
+        Ages every tracked object by n_frames frames
+        """
+        self.age += n_frames
+
+    def increment(self,detected_ids = [],n_frames = 1):
+        """
+        Increments frames since last detection (and measurement) for every 
+        tracked object by n_frames, then resets them to 0 for each object 
+        detected this frame
+        """
+        self.fsld += n_frames
+        self.fslm += n_frames
+        if len(detected_ids) > 0:
+            self.fsld[self.slots(detected_ids)] = 0
+            self.fslm[self.slots(detected_ids)] = 0
+
+    def measured(self,obj_ids):
+        """
+        Resets frames since last measurement for each object localized this frame
+        """
+        if len(obj_ids) > 0:
+            self.fslm[self.slots(obj_ids)] = 0
+
+    def vote(self,obj_ids,cls_preds,conf = None):
+        """
+        Adds one class vote per object and stores its latest confidence
+        obj_ids - list of length n of tracked ids
+        cls_preds - tensor of length n with predicted class index per object
+        conf - (optional) tensor of length n with confidence per object
+        """
+        if len(obj_ids) == 0:
+            return
+        slots = self.slots(obj_ids)
+        cls_preds = cls_preds.long().to(self.device)
+        self.votes.index_put_((slots,cls_preds),
+                              torch.ones(len(slots),device = self.device),
+                              accumulate = True)
+        if conf is not None:
+            self.conf[slots] = conf.float().to(self.device)
+
+    def lost(self,fsld_max):
+        """
+        Returns list of ids not detected for more than fsld_max frames
+        """
+        return self.ids[self.fsld > fsld_max].tolist()
+
+    def low_confidence(self,obj_ids,conf_min):
+        """
+        Returns the subset of obj_ids still tracked whose latest confidence
+        is below conf_min
+        """
+        if len(obj_ids) == 0 or len(self.ids) == 0:
+            return []
+        obj_ids = torch.as_tensor(obj_ids,dtype = torch.long).to(self.device)
+        slots = torch.searchsorted(self.ids,obj_ids).clamp(max = len(self.ids)-1)
+        active = self.ids[slots] == obj_ids
+        low = active & (self.conf[slots] < conf_min)
+        return obj_ids[low].tolist()
+
+    def votes_by_id(self):
+        """
+        Returns class vote histogram of every object ever tracked, keyed by id
+        """
+        out_dict = dict(self.retired)
+        for id,votes in zip(self.ids.tolist(),self.votes.cpu().numpy()):
+            out_dict[id] = votes
+        return out_dict
+
+    def classes(self):
+        """
+        Returns most-voted class of every object ever tracked, keyed by id
+        """
+        return {id:np.argmax(votes) for id,votes in self.votes_by_id().items()}
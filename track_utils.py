@@ -9,101 +9,117 @@ import os
 import numpy as np
 import random 
 import time
-import math
+import itertools
 import _pickle as pickle
 random.seed = 0
 
 import cv2
-from PIL import Image
 import torch
 
-from torchvision.transforms import functional as F
-from torchvision.ops import roi_align
 import matplotlib.pyplot  as plt
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
-from detrac_files.detrac_train_localizer import ResNet_Localizer, load_model, class_dict
-from pytorch_yolo_v3.yolo_detector import Darknet_Detector
+from detrac_files.detrac_train_localizer import load_model, class_dict
 from torch_kf import Torch_KF#, filter_wrapper
+from spatial_index import candidate_pairs, xysr_to_xyxy, self_pairs, pair_iou
+from track_lifecycle import Track_Lifecycle
+from trajectory_store import Trajectory_Store
+from localizer_batching import Chunked_Localizer
+from detection_scheduling import Detection_Scheduler
+from tracking_pipeline import track_pipelined
+from detector_process import Detector_Process
+import model_registry
+from frame_sources import Image_Directory_Source, Cached_Sequence_Source, Video_Source, Frame, is_video
 
 
-def parse_detections(detections):
-    # remove duplicates
-    detections = detections.unique(dim = 0)
-    
+def parse_detections(detections,keep_classes = [2,3,5,7]):
+    """
+    Converts raw detector output into tracker form without leaving the
+    detector's device. Class filtering and box conversion are single tensor
+    expressions rather than per-row python operations
+    detections - tensor of detector output rows
+    keep_classes - coco class indices to keep (car, motorbike, bus, truck)
+    """
     # input form --> batch_idx, xmin,ymin,xmax,ymax,objectness,max_class_conf, class_idx 
     # output form --> x_center,y_center, scale, ratio, class_idx, max_class_conf
     
-    output = torch.zeros(detections.shape[0],6)
-    detections  =  detections[:,1:]
+    # filter classes first so fewer rows need deduplicating
+    keep = torch.tensor(keep_classes,device = detections.device)
+    detections = detections[torch.isin(detections[:,7].long(),keep)]
     
-    output[:,0] = (detections[:,0] + detections[:,2]) / 2.0
-    output[:,1] = (detections[:,1] + detections[:,3]) / 2.0
-    output[:,2] = (detections[:,2] - detections[:,0])
-    output[:,3] = (detections[:,3] - detections[:,1]) / output[:,2]
-    output[:,4] =  detections[:,6]
-    output[:,5] =  detections[:,5]
-    
-    prune_output = []
-    for i in range(len(output)):
-        if int(output[i,4]) in [2,3,5,7]:
-            prune_output.append(i)
+    # remove duplicates
+    detections = detections.unique(dim = 0)
     
-    output = output[prune_output,:]
+    xmin,ymin,xmax,ymax = detections[:,1:5].unbind(1)
+    output = torch.stack(((xmin + xmax) / 2.0,
+                          (ymin + ymax) / 2.0,
+                          xmax - xmin,
+                          (ymax - ymin) / (xmax - xmin),
+                          detections[:,7],
+                          detections[:,6]),dim = 1)
     
     return output
 
 def match_hungarian(first,second,iou_cutoff = 0.5):
     """
     performs  optimal (in terms of sum distance) matching of points 
-    in first to second using the Hungarian algorithm
-    inputs - N x 2 arrays of object x and y coordinates from different frames
-    output - M x 1 array where index i corresponds to the second frame object 
-    matched to the first frame object i
+    in first to second using the Hungarian algorithm. Only pairs of boxes that
+    overlap by at least iou_cutoff (found with a spatial grid index) are 
+    considered, and the assignment is solved separately for each connected
+    group of overlapping boxes, so cost scales with overlaps rather than N x M
+    inputs - N x 4 arrays of object x,y,s,r boxes from different frames
+    output - M x 2 array where each row [i,j] matches first frame object i 
+    to second frame object j
     """
-    # find distances between first and second
-    dist = np.zeros([len(first),len(second)])
-    for i in range(0,len(first)):
-        for j in range(0,len(second)):
-            dist[i,j] = np.sqrt((first[i,0]-second[j,0])**2 + (first[i,1]-second[j,1])**2)
-            
-    a, b = linear_sum_assignment(dist)
+    if len(first) == 0 or len(second) == 0:
+        return np.zeros([0,2],dtype = int)
+    
+    # the assignment is solved on the host, so only box coordinates leave the device
+    if torch.is_tensor(first):
+        first = first[:,:4].detach().cpu()
+    if torch.is_tensor(second):
+        second = second[:,:4].detach().cpu()
+    first = np.asarray(first,dtype = float)[:,:4]
+    second = np.asarray(second,dtype = float)[:,:4]
+    
+    # supress matchings with iou below cutoff before assignment
+    pairs,ious = candidate_pairs(first,second)
+    pairs = pairs[ious >= iou_cutoff]
+    if len(pairs) == 0:
+        return np.zeros([0,2],dtype = int)
+    
+    # center distance for each candidate pair only
+    dist = np.sqrt(((first[pairs[:,0],:2] - second[pairs[:,1],:2])**2).sum(axis = 1))
+    
+    # split the bipartite overlap graph into independent connected groups
+    n = len(first)
+    graph = coo_matrix((np.ones(len(pairs)),(pairs[:,0],pairs[:,1] + n)),
+                       shape = (n + len(second),n + len(second)))
+    _,labels = connected_components(graph,directed = False)
+    group = labels[pairs[:,0]]
+    order = np.argsort(group,kind = "stable")
+    bounds = np.flatnonzero(np.diff(group[order])) + 1
+    
+    # non-candidate entries cost more than any full set of real matches
+    big = dist.sum() + 1
     
-    # convert into expected form
-    matchings = np.zeros(len(first))-1
-    for idx in range(0,len(a)):
-        matchings[a[idx]] = b[idx]
-    matchings = np.ndarray.astype(matchings,int)
-    
-    if True:
-        # calculate intersection over union  (IOU) for all matches
-        for i,j in enumerate(matchings):
-            x1_left = first[i][0] -first[i][2]*first[i][3]/2
-            x2_left = second[j][0] -second[j][2]*second[j][3]/2
-            x1_right= first[i][0] + first[i][2]*first[i][3]/2
-            x2_right = second[j][0] +second[j][2]*second[j][3]/2
-            x_intersection = min(x1_right,x2_right) - max(x1_left,x2_left) 
-            
-            y1_left = first[i][1] -first[i][2]/2.0
-            y2_left = second[j][1] -second[j][2]/2.0
-            y1_right= first[i][1] + first[i][2]/2.0
-            y2_right = second[j][1] +second[j][2]/2.0
-            y_intersection = min(y1_right,y2_right) - max(y1_left,y2_left)
-            
-            a1 = first[i,3]*first[i,2]**2 
-            a2 = second[j,3]*second[j,2]**2 
-            intersection = x_intersection*y_intersection
-             
-            iou = intersection / (a1+a2-intersection) 
-            
-            # supress matchings with iou below cutoff
-            if iou < iou_cutoff:
-                matchings[i] = -1
     out_matchings = []
-    for i in range(len(matchings)):
-        if matchings[i] != -1:
-            out_matchings.append([i,matchings[i]])
-    return np.array(out_matchings)   
+    for sel in np.split(order,bounds):
+        if len(sel) == 1:
+            out_matchings.append(pairs[sel[0]])
+            continue
+        rows,r_idx = np.unique(pairs[sel,0],return_inverse = True)
+        cols,c_idx = np.unique(pairs[sel,1],return_inverse = True)
+        sub = np.full([len(rows),len(cols)],big)
+        sub[r_idx,c_idx] = dist[sel]
+        a, b = linear_sum_assignment(sub)
+        real = sub[a,b] < big
+        out_matchings.extend(np.stack((rows[a[real]],cols[b[real]]),axis = 1))
+    
+    out_matchings = np.array(out_matchings,dtype = int)
+    return out_matchings[np.argsort(out_matchings[:,0])]
  
 def match_greedy(first,second,threshold = 10):
     """
@@ -174,63 +190,35 @@ def test_outputs(bboxes,crops):
             axs[i//row_size,i%row_size].set_yticks([])
         plt.pause(.001)    
     
-def load_models(device):
-    yolo_checkpoint =   "/home/worklab/Desktop/checkpoints/yolo/yolov3.weights"
-    resnet_checkpoint = "/home/worklab/Desktop/checkpoints/detrac_localizer/CPU_resnet18_epoch4.pt"
-    resnet_checkpoint = "/home/worklab/Desktop/checkpoints/detrac_localizer_retrain2/cpu_resnet18_epoch14.pt"
-
-    detector = Darknet_Detector(
-                'pytorch_yolo_v3/cfg/yolov3.cfg',
-                yolo_checkpoint,
-                'pytorch_yolo_v3/data/coco.names',
-                'pytorch_yolo_v3/pallete',
-                resolution = 1024
-                )
-            
-    localizer = ResNet_Localizer()
-    cp = torch.load(resnet_checkpoint)
-    localizer.load_state_dict(cp['model_state_dict']) 
-    localizer = localizer.to(device)
+def load_models(device,backend = "eager",quantized = False,localizer_checkpoint = None,load_detector = True):
+    """
+    Returns the detector and localizer, loaded once per process and shared 
+    between calls (see model_registry)
+    backend - localizer inference backend, one of localizer_backends.BACKENDS
+    quantized - load the int8 quantized localizer checkpoint (cpu only)
+    localizer_checkpoint - (optional) other localizer checkpoint to load, 
+                           e.g. a distilled Student_Localizer
+    load_detector - if False, only the localizer is loaded and detector is None
+    """
+    if localizer_checkpoint is None:
+        if quantized:
+            localizer_checkpoint = model_registry.QUANTIZED_CHECKPOINT
+        else:
+            localizer_checkpoint = model_registry.LOCALIZER_CHECKPOINT
+    detector = model_registry.get_detector(device) if load_detector else None
+    localizer = model_registry.get_localizer(device,localizer_checkpoint,backend = backend)
     
     print("Detector and Localizer on {}.".format(device))
     return detector,localizer
     
-def load_all_frames(track_directory,det_step,init_frames,cutoff = None): 
+def load_all_frames(track_directory,cutoff = None): 
+    """
+    Decodes every frame of a sequence into memory as uint8 Frames. Prefer 
+    iterating an Image_Directory_Source directly, which keeps only a few 
+    frames in memory
+    """
     print("Loading frames into memory.")
-    files = []
-    frames = []
-    for item in [os.path.join(track_directory,im) for im in os.listdir(track_directory)]:
-        files.append(item)
-        files.sort()
-        
-    # open and parse images    
-    for num, f in enumerate(files):
-         with Image.open(f) as im:
-             
-             if num % det_step < init_frames:   
-                 # convert to CV2 style image
-                 open_cv_image = np.array(im) 
-                 im = open_cv_image.copy() 
-                 original_im = im[:,:,[2,1,0]].copy()
-                 # new stuff
-                 dim = (im.shape[1], im.shape[0])
-                 im = cv2.resize(im, (1024,1024))
-                 im = im.transpose((2,0,1)).copy()
-                 im = torch.from_numpy(im).float().div(255.0).unsqueeze(0)
-                 dim = torch.FloatTensor(dim).repeat(1,2)
-             else:
-                 # keep as tensor
-                 original_im = np.array(im)[:,:,[2,1,0]].copy()
-                 im = F.to_tensor(im)
-                 im = F.normalize(im,mean=[0.485, 0.456, 0.406],
-                                      std=[0.229, 0.224, 0.225])
-                 dim = None
-                 
-                 # store preprocessed image, dimensions and original image
-             frames.append((im,dim,original_im))
-             if cutoff is not None and num > cutoff:
-                 break
-             
+    frames = list(Image_Directory_Source(track_directory,cutoff = cutoff))
     n_frames = len(frames)
      
     print("All frames loaded into memory")
@@ -307,379 +295,630 @@ def iou(a,b):
     iou = intersection/union
     
     return iou
+
+def suppress_overlaps(locations,lifecycle,iou_cutoff = 0.5):
+    """
+    Finds tracked objects that overlap another tracked object with iou above
+    iou_cutoff. Overlapping pairs come from the spatial grid index, so only
+    boxes that actually intersect are compared. Of each pair, the object that
+    has been around for less time (ties broken by newer id) is marked for removal
+    locations - dict of xysr(...) states keyed by object id
+    lifecycle - Track_Lifecycle holding the age of each tracked object
+    returns - list of object ids to remove
+    """
+    ids = list(locations.keys())
+    if len(ids) < 2:
+        return []
+    boxes = xysr_to_xyxy(np.array([locations[id][:4] for id in ids]))
+    pairs = self_pairs(boxes)
+    pairs = pairs[pair_iou(boxes,boxes,pairs) > iou_cutoff]
+    if len(pairs) == 0:
+        return []
+    
+    # determine which object has been around longer
+    age = lifecycle.age[lifecycle.slots(ids)].cpu().numpy()
+    ids = np.array(ids)
+    i,j = pairs[:,0],pairs[:,1]
+    i_older = (age[i] > age[j]) | ((age[i] == age[j]) & (ids[i] < ids[j]))
+    removals = np.where(i_older,ids[j],ids[i])
+    return np.unique(removals).tolist()
+    
+    
+class Tracker(object):
+    """
+    Stateful frame-at-a-time tracker. Holds the detector, localizer, Kalman 
+    filter and per-object lifecycle state so frames can be fed one at a time
+    with step(), and accumulated trajectories collected with flush(). Every
+    det_step frames, init_frames consecutive frames are processed with the 
+    detector; all other frames are processed by localizing each tracked
+    object within a crop around its predicted location
+    """
     
-    
-def skip_track(track_path, tracker, det_step = 1, srr = 0, ber = 1, PLOT = True):
+    def __init__(self, kf, detector = None, localizer = None, det_step = 1, 
+                 srr = 0, ber = 1, init_frames = 3, PLOT = False, device = None,
+                 chunk_size = None, memory_budget = None, latency_budget = None,
+                 autotune = False, backend = "eager", quantized = False, localizer_checkpoint = None,
+                 crop_sizes = [224], localize_k = None, localize_budget = None, 
+                 localize_threshold = None, max_unmeasured = None, scheduler = None):
+        """
+        kf - Torch_KF object used to track object states
+        detector,localizer - (optional) already loaded models, loaded if None. detector
+                     may be a running Detector_Process
+        det_step - detection is run on init_frames consecutive frames every det_step frames
+        srr - scale ratio regression, weight given to localizer scale and ratio outputs
+        ber - box expansion ratio, crop size relative to predicted box size
+        chunk_size,memory_budget,latency_budget,autotune - bound localizer batches, see 
+                     Chunked_Localizer. Chunk sizes are chosen here, before any timing
+        backend,quantized,localizer_checkpoint - localizer to use if models are loaded here, see load_models
+        crop_sizes - localizer input resolutions, objects are batched by the smallest
+                     that covers their crop (e.g. [96,160,224] with a localizer
+                     fine-tuned for multi-resolution input)
+        localize_k,localize_budget,localize_threshold - (optional) on localization 
+                     frames, only objects ranked most uncertain are localized: at most
+                     localize_k objects, as many as fit in localize_budget seconds per
+                     frame, and only those scoring above localize_threshold. All
+                     objects are localized if none are set
+        max_unmeasured - (optional) objects unmeasured for this many frames are always localized
+        scheduler - (optional) Detection_Scheduler deciding when to run the detector,
+                     replacing the fixed det_step schedule
+        """
+        self.kf = kf
+        self.det_step = det_step
+        self.srr = srr
+        self.ber = ber
+        self.init_frames = init_frames
+        self.crop_sizes = crop_sizes
+        self.localize_k = localize_k
+        self.localize_budget = localize_budget
+        self.localize_threshold = localize_threshold
+        self.max_unmeasured = max_unmeasured
+        self.selection_weights = [1.0,0.1,1.0] # uncertainty, frames since measured, speed
+        self.crop_time = None                  # running estimate of seconds to localize one object
+        self.scheduler = scheduler
+        self.fsld_max = det_step if scheduler is None else scheduler.max_interval
+        self.PLOT = PLOT
         
-    init_frames = 3
-    
-    fsld_max = det_step
-    
-    # CUDA for PyTorch
-    use_cuda = torch.cuda.is_available()
-    device = torch.device("cuda:0" if use_cuda else "cpu")
-    torch.cuda.empty_cache() 
-            
-    # get CNNs
-    try:
-        detector
-        localizer
-    except:
-        detector,localizer = load_models(device)
+        # CUDA for PyTorch
+        if device is None:
+            use_cuda = torch.cuda.is_available()
+            device = torch.device("cuda:0" if use_cuda else "cpu")
+        self.device = torch.device(device)
+        torch.cuda.empty_cache() 
         
-    
-    localizer.eval()
-         
-    # Loop Setup
-    frames,n_frames = load_all_frames(track_path,det_step,init_frames,cutoff = None)
-    
-    frame_num = 0               # iteration counter   
-    next_obj_id = 0             # next id for a new object (incremented during tracking)
-    fsld = {}                   # fsld[id] stores frames since last detected for object id
-    
-    all_tracks = {}             # stores states for each object
-    all_classes = {}            # stores class evidence for each object
-    
-    # for keeping track of what's using up time
-    time_metrics = {            
-        "gpu_load":0,
-        "predict":0,
-        "pre_localize and align":0,
-        "localize":0,
-        "post_localize":0,
-        "detect":0,
-        "parse":0,
-        "match":0,
-        "match2":0,
-        "update":0,
-        "add and remove":0,
-        "store":0,
-        "plot":0
-        }
-                
-                
-    # 3. Main Loop
-
-    for (frame,dim,original_im) in frames:
+        # get CNNs
+        if detector is None or localizer is None:
+            loaded_detector,loaded_localizer = load_models(self.device,backend = backend,quantized = quantized,
+                                                           localizer_checkpoint = localizer_checkpoint,
+                                                           load_detector = detector is None)
+            detector = loaded_detector if detector is None else detector
+            localizer = loaded_localizer if localizer is None else localizer
+        self.detector = detector
+        self.localizer = localizer
+        self.localizer.eval()
+        self.localize_chunks = Chunked_Localizer(localizer,self.device,chunk_size = chunk_size,
+                                                 memory_budget = memory_budget,
+                                                 latency_budget = latency_budget,
+                                                 autotune = autotune)
+        self.localize_chunks.warm_up([(3,size,size) for size in crop_sizes])
+        
+        self.frame_num = 0               # iteration counter   
+        self.last_detection = -np.inf    # frame_num of last frame processed by detector
+        self.next_obj_id = 0             # next id for a new object (incremented during tracking)
+        self.lifecycle = Track_Lifecycle(kf.device) # fsld, age and class evidence per object
+        self.all_tracks = Trajectory_Store() # stores states for each object in each frame
+        self.pending_detections = {}     # detector output for upcoming frames, keyed by frame_num
+        
+        # for keeping track of what's using up time
+        self.time_metrics = {            
+            "gpu_load":0,
+            "predict":0,
+            "pre_localize and align":0,
+            "localize":0,
+            "post_localize":0,
+            "detect":0,
+            "parse":0,
+            "match":0,
+            "match2":0,
+            "update":0,
+            "add and remove":0,
+            "store":0,
+            "plot":0,
+            "pipeline wait":0
+            }
+        
+        # time spent concurrently with tracking (e.g. by a pipelined detection 
+        # stage), reported separately since it doesn't add to wall time
+        self.overlapped_metrics = {
+            "detect":0
+            }
+    
+    def detect_frame(self,frame_num):
+        """
+        Returns True if frame frame_num is processed with the detector. If
+        frames were dropped such that a whole detection cycle was missed, 
+        the next frame is processed with the detector
+        """
+        if self.scheduler is not None:
+            return self.scheduler.detect_frame(frame_num,self.kf,self.lifecycle)
+        return (frame_num % self.det_step < self.init_frames or 
+                frame_num - self.last_detection > self.det_step)
+    
+    def detection_burst(self,frame_num = None):
+        """
+        Returns the number of consecutive frames, starting at frame_num (by 
+        default the next frame), that are scheduled to be processed with the 
+        detector (at most init_frames). Returns 0 when a Detection_Scheduler 
+        decides frame by frame
+        """
+        if frame_num is None:
+            frame_num = self.frame_num
+        if self.scheduler is not None:
+            return 0
+        n = 0
+        while n < self.init_frames and (frame_num + n) % self.det_step < self.init_frames:
+            n += 1
+        return n
+    
+    def detect_batch(self,frames):
+        """
+        Runs the detector on frames in a single batch. Depends only on the 
+        frames, not on tracker state, so it is safe to call from another thread
+        frames - list of Frame
+        returns - list of detector output for each frame
+        """
+        if isinstance(self.detector,Detector_Process):
+            return self.detector.detect_frames(frames)
+        
+        inputs = [frame.detector_input(self.device) for frame in frames]
+        ims = torch.cat([im for im,dim in inputs])
+        dims = torch.cat([dim for im,dim in inputs])
+        
+        # first column of detector output is index of the frame within the batch
+        detections = self.detector.detect2(ims,dims)
+        self._synchronize()
+        return [detections[detections[:,0] == i] for i in range(len(frames))]
+    
+    def detect_ahead(self,frames):
+        """
+        Runs the detector on the next len(frames) frames in a single batch. 
+        Each frame's detections are used when it is passed to step(), so
+        frames must be stepped in order
+        frames - list of Frame or H x W x 3 uint8 RGB arrays
+        returns - frames, as Frame objects
+        """
+        frames = [frame if isinstance(frame,Frame) else Frame(frame,self.frame_num + i)
+                  for i,frame in enumerate(frames)]
         
-        # 1. Move image to GPU
         start = time.time()
-        frame = frame.to(device,non_blocking = True)
-        if frame_num % det_step < init_frames: #if frame_num % det_step == 0:
-            dim = dim.to(device,non_blocking = True)                      
-        time_metrics['gpu_load'] += time.time() - start
+        for i,detections in enumerate(self.detect_batch(frames)):
+            self.pending_detections[self.frame_num + i] = detections
+        self.time_metrics['detect'] += time.time() - start
+        return frames
+    
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+    
+    def step(self,frame):
+        """
+        Processes the next frame of the sequence
+        frame - Frame, as yielded by Image_Directory_Source, or H x W x 3
+                uint8 RGB array
+        returns - list of object dicts (fields id, class_num, bbox (x0,y0,x1,y1))
+                  for every object tracked in this frame
+        """
+        if not isinstance(frame,Frame):
+            frame = Frame(frame,self.frame_num)
+        tm = self.time_metrics
         
-
         # 2. Predict next object locations
         start = time.time()
-        try: # in the case that there are no active objects will throw exception
-
-            tracker.predict()
-            pre_locations = tracker.objs()
-        except:
-            pre_locations = []    
-        time_metrics['predict'] += time.time() - start
-    
-       
-        if frame_num % det_step < init_frames: #Use YOLO
-            # 3a. YOLO detect                            
-            detections = detector.detect2(frame,dim)
-            torch.cuda.synchronize(device)
-            time_metrics['detect'] += time.time() - start
-            
-            start = time.time()
-            detections = detections.cpu()
-            time_metrics['gpu_load'] += time.time() - start
-
+        if len(self.lifecycle) > 0:
+            self.kf.predict()
+        pre_locations = self.kf.objs()
+        tm['predict'] += time.time() - start
+        
+        if self.detect_frame(self.frame_num): #Use YOLO
+            detections = self._detect(frame,pre_locations)
+            self.last_detection = self.frame_num
+        elif len(pre_locations) > 0: # use Resnet  
+            detections = self._localize(frame,pre_locations)
+        else:
+            detections = []
+        
+        # IOU suppression on overlapping bounding boxes
+        locations = self.kf.objs()
+        removals = suppress_overlaps(locations,self.lifecycle,iou_cutoff = 0.5)
+        self._remove(removals)
+        self.lifecycle.step()
             
-            # postprocess detections
-            start = time.time()
-            detections = parse_detections(detections)
-            time_metrics['parse'] += time.time() - start
-         
-            # 4a. Match, using Hungarian Algorithm        
+        # 9. Get all object locations and store in output dict
+        start = time.time()
+        post_locations = self.kf.objs()
+        self.all_tracks.append(self.frame_num,list(post_locations.keys()),list(post_locations.values()))
+        tm['store'] += time.time() - start  
+        
+        # 10. Plot
+        start = time.time()
+        if self.PLOT:
+            plot(frame.bgr(),detections,post_locations,self.lifecycle.votes_by_id(),class_dict,frame = self.frame_num)
+        tm['plot'] += time.time() - start
+        
+        # increment frame counter 
+        if self.frame_num % 1000 == 0:
+            print("Finished frame {}".format(self.frame_num))
+        self.frame_num += 1
+        torch.cuda.empty_cache()
+        
+        # objects in post_locations are in Torch_KF row order, as are lifecycle rows
+        classes = self.lifecycle.votes.argmax(dim = 1).tolist()
+        bboxes = xysr_to_xyxy(list(post_locations.values()))
+        tracks = []
+        for i,id in enumerate(post_locations):
+            tracks.append({"id":id,"class_num":classes[i],"bbox":bboxes[i]})
+        return tracks
+    
+    def skip(self,n_frames = 1):
+        """
+        Advances all tracked objects through n_frames frames that will not be
+        processed (e.g. dropped to keep up with a live feed) using Kalman 
+        filter prediction alone. The predicted states are stored for each 
+        skipped frame, so flush() still returns one list per frame. The next 
+        call to step() processes frame frame_num + n_frames
+        """
+        if n_frames <= 0:
+            return
+        start = time.time()
+        for i in range(n_frames):
+            if len(self.lifecycle) > 0:
+                self.kf.predict()
+            locations = self.kf.objs()
+            self.all_tracks.append(self.frame_num,list(locations.keys()),list(locations.values()))
+            self.frame_num += 1
+        self.lifecycle.increment(n_frames = n_frames)
+        self.lifecycle.step(n_frames)
+        self.pending_detections = {f:d for f,d in self.pending_detections.items() if f >= self.frame_num}
+        self.time_metrics['predict'] += time.time() - start
+    
+    def _remove(self,removals):
+        if len(removals) > 0:
+            self.kf.remove(removals)
+            self.lifecycle.remove(removals)
+    
+    def _detect(self,frame,pre_locations):
+        """
+        Detects objects in full frame, matches them to tracked objects and
+        adds unmatched detections as new objects
+        """
+        tm = self.time_metrics
+        
+        if self.frame_num in self.pending_detections:
+            # already detected in a batch by detect_ahead
+            detections = self.pending_detections.pop(self.frame_num)
+        elif isinstance(self.detector,Detector_Process):
+            # frame is copied to the detector process's shared ring as is
             start = time.time()
-            
-            pre_ids = []
-            pre_loc = []
-            for id in pre_locations:
-                pre_ids.append(id)
-                pre_loc.append(pre_locations[id])
-            pre_loc = np.array(pre_loc)
-            
-            # matchings[i] = [a,b] where a is index of pre_loc and b is index of detection
-            matchings = match_hungarian(pre_loc,detections[:,:4],iou_cutoff = 0.05)
-            time_metrics['match'] += time.time() - start
-            
-            # try:
-            #     start = time.time()
-            #     matchings2 = match_greedy(pre_loc,detections[:,:4], threshold = 200)
-            #     time_metrics['match2'] += time.time() - start
-            # except:
-            #     print("failed")
-            
-            # 5a. Update tracked objects
+            detections = self.detector.detect_frames([frame])[0]
+            tm['detect'] += time.time() - start
+        else:
+            # 1. Resize frame for detector and move to GPU
             start = time.time()
-    
-            update_array = np.zeros([len(matchings),4])
-            update_ids = []
-            for i in range(len(matchings)):
-                a = matchings[i,0] # index of pre_loc
-                b = matchings[i,1] # index of detections
-               
-                update_array[i,:] = detections[b,:4]
-                update_ids.append(pre_ids[a])
-                fsld[pre_ids[a]] = 0 # fsld = 0 since this id was detected this frame
+            im,dim = frame.detector_input(self.device)
+            tm['gpu_load'] += time.time() - start
             
-            if len(update_array) > 0:    
-                tracker.update(update_array,update_ids)
-              
-                time_metrics['update'] += time.time() - start
-                  
-            
-            # 6a. For each detection not in matchings, add a new object
+            # 3a. YOLO detect                            
             start = time.time()
-            
-            new_array = np.zeros([len(detections) - len(matchings),4])
-            new_ids = []
-            cur_row = 0
-            for i in range(len(detections)):
-                if len(matchings) == 0 or i not in matchings[:,1]:
-                    
-                    new_ids.append(next_obj_id)
-                    new_array[cur_row,:] = detections[i,:4]
-    
-                    fsld[next_obj_id] = 0
-                    all_tracks[next_obj_id] = np.zeros([n_frames,7])
-                    all_classes[next_obj_id] = np.zeros(13)
-                    
-                    next_obj_id += 1
-                    cur_row += 1
-           
-            if len(new_array) > 0:        
-                tracker.add(new_array,new_ids)
-            
-            
-            # 7a. For each untracked object, increment fsld        
-            for i in range(len(pre_ids)):
-                try:
-                    if i not in matchings[:,0]:
-                        fsld[pre_ids[i]] += 1
-                except:
-                    fsld[pre_ids[i]] += 1
-            
-            # 8a. remove lost objects
-            removals = []
-            for id in pre_ids:
-                if fsld[id] > fsld_max:
-                    removals.append(id)
-           
-            if len(removals) > 0:
-                tracker.remove(removals)    
-            
-            time_metrics['add and remove'] += time.time() - start
-
+            detections = self.detector.detect2(im,dim)
+            self._synchronize()
+            tm['detect'] += time.time() - start
+        
+        # postprocess detections, staying on the detector's device
+        start = time.time()
+        detections = parse_detections(detections)
+        tm['parse'] += time.time() - start
+     
+        # 4a. Match, using Hungarian Algorithm        
+        start = time.time()
+        pre_ids = list(pre_locations.keys())
+        pre_loc = np.array(list(pre_locations.values()))
+        
+        # matchings[i] = [a,b] where a is index of pre_loc and b is index of detection
+        matchings = match_hungarian(pre_loc,detections[:,:4],iou_cutoff = 0.05)
+        tm['match'] += time.time() - start
+        
+        # 5a. Update tracked objects
+        start = time.time()
+        det_idxs = torch.from_numpy(matchings[:,1]).to(detections.device)
+        update_ids = [pre_ids[a] for a in matchings[:,0]]
+        if len(update_ids) > 0:    
+            self.kf.update(detections[det_idxs,:4],update_ids)
+        
+        # 7a. increment fsld for each untracked object, fsld = 0 for detected ones
+        self.lifecycle.increment(update_ids)
+        tm['update'] += time.time() - start
+        
+        # 6a. For each detection not in matchings, add a new object
+        start = time.time()
+        unmatched = torch.ones(len(detections),dtype = torch.bool,device = detections.device)
+        unmatched[det_idxs] = False
+        new_array = detections[unmatched,:4]
+        new_ids = list(range(self.next_obj_id,self.next_obj_id + len(new_array)))
+        self.next_obj_id += len(new_ids)
+        if len(new_array) > 0:        
+            self.kf.add(new_array,new_ids)
+            self.lifecycle.add(new_ids)
+        if self.scheduler is not None:
+            self.scheduler.detected(self.frame_num,new_array,frame.dim)
+        
+        # 8a. remove lost objects
+        self._remove(self.lifecycle.lost(self.fsld_max))
+        tm['add and remove'] += time.time() - start
+        
+        return detections
+    
+    def _localize(self,frame,pre_locations):
+        """
+        Crops each tracked object's predicted location from frame, localizes
+        the object within the crop and updates tracked objects accordingly
+        """
+        tm = self.time_metrics
+        localize_start = time.time()
+        
+        # 3b. crop tracked objects from image
+        start = time.time()
+        # objects not selected advance on prediction alone
+        box_ids = self.select_for_localization(list(pre_locations.keys()))
+        if len(box_ids) == 0:
+            self.lifecycle.increment()
+            return np.zeros([0,4])
+        
+        # use predicted states to crop relevant portions of frame 
+        boxes = np.array([pre_locations[id][:4] for id in box_ids])
+        all_boxes = np.array([pre_locations[id][:4] for id in pre_locations])
+        
+        # convert xysr boxes into xmin xmax ymin ymax
+        # first row of zeros is batch index (batch is size 0) for ROI align
+        new_boxes = np.zeros([len(boxes),5]) 
 
+        # use either s or s x r for both dimensions, whichever is larger,so crop is square
+        #box_scales = np.max(np.stack((boxes[:,2],boxes[:,2]*boxes[:,3]),axis = 1),axis = 1)
+        box_scales = np.min(np.stack((boxes[:,2],boxes[:,2]*boxes[:,3]),axis = 1),axis = 1) #/2.0
             
-        elif True: # use Resnet  
-            # 3b. crop tracked objects from image
+        #expand box slightly
+        box_scales = box_scales * self.ber# box expansion ratio
+        
+        new_boxes[:,1] = boxes[:,0] - box_scales/2
+        new_boxes[:,3] = boxes[:,0] + box_scales/2 
+        new_boxes[:,2] = boxes[:,1] - box_scales/2 
+        new_boxes[:,4] = boxes[:,1] + box_scales/2 
+        
+        # each object is cropped at the smallest crop size at least as large as 
+        # its crop in the frame (or the largest size), so small distant objects
+        # are localized at low resolution
+        crop_sizes = np.sort(self.crop_sizes)
+        buckets = np.minimum(np.searchsorted(crop_sizes,box_scales),len(crop_sizes) - 1)
+        rect_boxes = xysr_to_xyxy(boxes)
+        occluders = xysr_to_xyxy(all_boxes)
+        tm['pre_localize and align'] += time.time() - start
+        
+        cls_outs = []
+        reg_outs = []
+        order = []
+        for bucket in np.unique(buckets):
+            # crop and normalize, blanking other objects' boxes (these boxes are
+            # not square) within each crop
             start = time.time()
-            # use predicted states to crop relevant portions of frame 
-            box_ids = []
-            box_list = []
-            
-            # convert to array
-            for id in pre_locations:
-                box_ids.append(id)
-                box_list.append(pre_locations[id][:4])
-            boxes = np.array(box_list)
-            
-            # convert xysr boxes into xmin xmax ymin ymax
-            # first row of zeros is batch index (batch is size 0) for ROI align
-            new_boxes = np.zeros([len(boxes),5]) 
-
-            # use either s or s x r for both dimensions, whichever is larger,so crop is square
-            #box_scales = np.max(np.stack((boxes[:,2],boxes[:,2]*boxes[:,3]),axis = 1),axis = 1)
-            box_scales = np.min(np.stack((boxes[:,2],boxes[:,2]*boxes[:,3]),axis = 1),axis = 1) #/2.0
-                
-            #expand box slightly
-            box_scales = box_scales * ber# box expansion ratio
-            
-            new_boxes[:,1] = boxes[:,0] - box_scales/2
-            new_boxes[:,3] = boxes[:,0] + box_scales/2 
-            new_boxes[:,2] = boxes[:,1] - box_scales/2 
-            new_boxes[:,4] = boxes[:,1] + box_scales/2 
-            torch_boxes = torch.from_numpy(new_boxes).float().to(device)
-            
-            if True: # mask other bboxes
-                # these boxes are not square
-                rect_boxes = np.zeros([len(boxes),4])
-                rect_boxes[:,0] = boxes[:,0] - boxes[:,2] / 2.0
-                rect_boxes[:,1] = boxes[:,1] - boxes[:,2] * boxes[:,3] / 2.0 
-                rect_boxes[:,2] = boxes[:,0] + boxes[:,2] / 2.0
-                rect_boxes[:,3] = boxes[:,1] + boxes[:,2] * boxes[:,3] / 2.0 
-                rect_boxes = rect_boxes.astype(int)
-                frame_copy = frame.clone()
-                for rec in rect_boxes:
-                    frame_copy[:,rec[1]:rec[3],rec[0]:rec[2]] = 0
-                frame_copy = frame_copy.unsqueeze(0).repeat(len(boxes),1,1,1)
-                
-                # in each crop, replace active box with correct pixels
-                for i in range(len(rect_boxes)):
-                    torch_boxes[i,0] = i # so images are indexed correctly
-                    rec = rect_boxes[i]
-                    frame_copy[i,:,rec[1]:rec[3],rec[0]:rec[2]] = frame[:,rec[1]:rec[3],rec[0]:rec[2]]
+            sel = np.flatnonzero(buckets == bucket)
+            crops = frame.localizer_crops(self.device,new_boxes[sel,1:],mask_boxes = rect_boxes[sel],
+                                          occluders = occluders,size = int(crop_sizes[bucket]))
+            tm['pre_localize and align'] += time.time() - start
             
-            else:
-                frame_copy = frame.unsqueeze(0)
-            # crop using roi align 
-            crops = roi_align(frame_copy,torch_boxes,(224,224))
-            time_metrics['pre_localize and align'] += time.time() - start
-            
-            
-            
-            # 4b. Localize objects using localizer
+            # 4b. Localize objects using localizer, one batch per crop size
             start= time.time()
-            cls_out,reg_out = localizer(crops)
-            torch.cuda.synchronize()
-            time_metrics['localize'] += time.time() - start
-            
-            start = time.time()
-            if  False:
-                test_outputs(reg_out,crops)
-            
-            # store class predictions
-            highest_conf,cls_preds = torch.max(cls_out,1)
-            for i in range(len(cls_preds)):
-                all_classes[box_ids[i]][cls_preds[i].item()] += 1
-            
-            
-            # 5b. convert to global image coordinates 
-                
-            # these detections are relative to crops - convert to global image coords
-            wer = 3 # window expansion ratio, was set during training
-            
-            detections = (reg_out* 224*wer - 224*(wer-1)/2)
-            detections = detections.data.cpu()
+            cls_out,reg_out = self.localize_chunks(crops)
+            self._synchronize()
+            tm['localize'] += time.time() - start
+            cls_outs.append(cls_out)
+            reg_outs.append(reg_out)
+            order.append(sel)
+        
+        start = time.time()
+        # restore object order
+        order = torch.from_numpy(np.concatenate(order))
+        cls_out = torch.empty_like(torch.cat(cls_outs))
+        reg_out = torch.empty_like(torch.cat(reg_outs))
+        cls_out[order] = torch.cat(cls_outs)
+        reg_out[order] = torch.cat(reg_outs)
+        
+        if  False:
+            test_outputs(reg_out,crops)
+        
+        # store class predictions
+        highest_conf,cls_preds = torch.max(cls_out,1)
+        self.lifecycle.vote(box_ids,cls_preds,highest_conf)
+        
+        # 5b. convert to global image coordinates 
             
-            # add in original box offsets and scale outputs by original box scales
-            detections[:,0] = detections[:,0]*box_scales/224 + new_boxes[:,1]
-            detections[:,2] = detections[:,2]*box_scales/224 + new_boxes[:,1]
-            detections[:,1] = detections[:,1]*box_scales/224 + new_boxes[:,2]
-            detections[:,3] = detections[:,3]*box_scales/224 + new_boxes[:,2]
+        # these detections are relative to crops - convert to global image coords
+        # reg_out is normalized to the crop window, so this holds at any crop size
+        wer = 3 # window expansion ratio, was set during training
+        
+        detections = (reg_out* 224*wer - 224*(wer-1)/2)
+        detections = detections.data.cpu()
+        
+        # add in original box offsets and scale outputs by original box scales
+        detections[:,0] = detections[:,0]*box_scales/224 + new_boxes[:,1]
+        detections[:,2] = detections[:,2]*box_scales/224 + new_boxes[:,1]
+        detections[:,1] = detections[:,1]*box_scales/224 + new_boxes[:,2]
+        detections[:,3] = detections[:,3]*box_scales/224 + new_boxes[:,2]
 
-            # convert into xysr form 
-            output = np.zeros([len(detections),4])
-            output[:,0] = (detections[:,0] + detections[:,2]) / 2.0
-            output[:,1] = (detections[:,1] + detections[:,3]) / 2.0
-            output[:,2] = (detections[:,2] - detections[:,0])
-            output[:,3] = (detections[:,3] - detections[:,1]) / output[:,2]
-            
-            
-            #lastly, replace scale and ratio with original values 
-            ## NOTE this is kind of a cludgey fix and ideally localizer should be better
-            output[:,2:4] = srr*output[:,2:4] + (1-srr)*boxes[:,2:4] 
-            time_metrics['post_localize'] += time.time() - start
-            detections = output
+        # convert into xysr form 
+        output = np.zeros([len(detections),4])
+        output[:,0] = (detections[:,0] + detections[:,2]) / 2.0
+        output[:,1] = (detections[:,1] + detections[:,3]) / 2.0
+        output[:,2] = (detections[:,2] - detections[:,0])
+        output[:,3] = (detections[:,3] - detections[:,1]) / output[:,2]
+        
+        #lastly, replace scale and ratio with original values 
+        ## NOTE this is kind of a cludgey fix and ideally localizer should be better
+        output[:,2:4] = self.srr*output[:,2:4] + (1-self.srr)*boxes[:,2:4] 
+        tm['post_localize'] += time.time() - start
 
-            # 6b. Update tracker
-            start = time.time()
-            # map regressed bboxes directly to objects for update step
-            tracker.update(output,box_ids)
-            time_metrics['update'] += time.time() - start
-            
-            # 7b. increment all fslds
-            for i in range(len(pre_ids)):
-                    fsld[pre_ids[i]] += 1
+        # 6b. Update tracker
+        start = time.time()
+        # map regressed bboxes directly to objects for update step
+        self.kf.update(output,box_ids)
+        tm['update'] += time.time() - start
         
+        # 7b. increment all fslds
+        self.lifecycle.increment()
+        self.lifecycle.measured(box_ids)
         
-            # Low confidence removals
-            if True:
-                removals = []
-                locations = tracker.objs()
-                for i in range(len(box_ids)):
-                    if highest_conf[i] < 3 and box_ids[i] in locations:
-                        removals.append(box_ids[i])
-                        print("Removed low confidence object")
-                tracker.remove(removals)
+        # per-object cost, for fitting localization into the compute budget
+        crop_time = (time.time() - localize_start) / len(box_ids)
+        if self.crop_time is None:
+            self.crop_time = crop_time
+        else:
+            self.crop_time = 0.9 * self.crop_time + 0.1 * crop_time
+    
+        # Low confidence removals
+        removals = self.lifecycle.low_confidence(box_ids,3)
+        if len(removals) > 0:
+            print("Removed {} low confidence objects".format(len(removals)))
+        self._remove(removals)
         
-        # IOU suppression on overlapping bounding boxes
-        if True:
-            removals = []
-            locations = tracker.objs()
-            for i in locations:
-                for j in locations:
-                    if i != j:
-                        iou_metric = iou(locations[i],locations[j])
-                        if iou_metric > 0.5:
-                            # determine which object has been around longer
-                            if len(all_classes[i]) > len(all_classes[j]):
-                                removals.append(j)
-                            else:
-                                removals.append(i)
-            removals = list(set(removals))
-            tracker.remove(removals)
-            
-            
-        # 9. Get all object locations and store in output dict
-        start = time.time()
-        post_locations = tracker.objs()
-        for id in post_locations:
-            all_tracks[id][frame_num,:] = post_locations[id][:7]        
-        time_metrics['store'] += time.time() - start  
+        return output
+    
+    def select_for_localization(self,obj_ids):
+        """
+        Ranks tracked objects by how much a measurement is needed: position 
+        uncertainty (square root of the trace of the KF x,y covariance), frames 
+        since last measurement and speed, the first and last relative to object 
+        size. Returns the highest ranked objects within localize_k, 
+        localize_budget and localize_threshold, plus any object unmeasured for
+        max_unmeasured frames
+        """
+        k = self.localize_k
+        if self.localize_budget is not None and self.crop_time is not None:
+            k_budget = max(1,int(self.localize_budget / self.crop_time))
+            k = k_budget if k is None else min(k,k_budget)
+        if k is None and self.localize_threshold is None:
+            return obj_ids
         
+        rows = torch.tensor([self.kf.obj_idxs[id] for id in obj_ids],device = self.kf.X.device)
+        X = self.kf.X[rows]
+        P = self.kf.P[rows]
+        scale = X[:,2].abs().clamp(min = 1)
+        uncertainty = torch.sqrt(P[:,0,0] + P[:,1,1]) / scale
+        speed = torch.sqrt(X[:,4]**2 + X[:,5]**2) * self.kf.t / scale
+        fslm = self.lifecycle.fslm[self.lifecycle.slots(obj_ids)].to(X.device).float()
         
-        # 10. Plot
-        start = time.time()
-        if PLOT:
-            plot(original_im,detections,post_locations,all_classes,class_dict,frame = frame_num)
-        time_metrics['plot'] += time.time() - start
-   
-            
-        # increment frame counter 
-        if frame_num % 1000 == 0:
-            print("Finished frame {}".format(frame_num))
-        frame_num += 1
-        torch.cuda.empty_cache()
-            
+        w = self.selection_weights
+        score = (w[0]*uncertainty + w[1]*fslm + w[2]*speed).cpu()
+        
+        keep = torch.ones(len(obj_ids),dtype = torch.bool)
+        if self.localize_threshold is not None:
+            keep &= score > self.localize_threshold
+        if k is not None:
+            rank = torch.empty(len(obj_ids),dtype = torch.long)
+            rank[torch.argsort(score,descending = True)] = torch.arange(len(obj_ids))
+            keep &= rank < k
+        if self.max_unmeasured is not None:
+            keep |= fslm.cpu() >= self.max_unmeasured
+        
+        return [obj_ids[i] for i in np.flatnonzero(keep.numpy())]
+    
+    def flush(self):
+        """
+        Returns tracked object dicts for every frame processed since the last 
+        flush (one list per frame, as expected by mot_eval.evaluate_mot) and 
+        clears stored trajectories. Objects still being tracked continue to be 
+        tracked in subsequent frames
+        """
+        first_frame = self.all_tracks.first_frame
+        final_output = self.all_tracks.to_output(self.frame_num - first_frame,self.lifecycle.classes())
+        
+        # objects that are no longer tracked won't appear in later frames
+        self.all_tracks = Trajectory_Store(first_frame = self.frame_num)
+        self.lifecycle.retired = {}
+        
+        if self.PLOT:
+            cv2.destroyAllWindows()
+        return final_output
     
-    cv2.destroyAllWindows()
+    def framerate(self):
+        """
+        Returns average frames per second processed so far
+        """
+        total_time = sum(self.time_metrics.values())
+        return self.frame_num / total_time if total_time > 0 else 0
     
-    del frames
     
-    total_time = 0
-    for key in time_metrics:
-        total_time += time_metrics[key]
+def skip_track(track_path, tracker, det_step = 1, srr = 0, ber = 1, PLOT = True, cache_root = None,
+               localizer_checkpoint = None, adaptive = False, pipelined = False, detector = None):
+    """
+    Tracks all frames in track_path (a directory of images or a video file) and
+    returns the tracked objects for each frame, the average framerate, and the
+    time spent in each operation
+    tracker - Torch_KF object
+    cache_root - (optional) directory of memory-mapped frame caches, frames
+                 are decoded from track_path on every call if None
+    localizer_checkpoint - (optional) localizer to track with instead of the default
+    adaptive - if True, detection is scheduled by Detection_Scheduler, at most 
+               2 x det_step frames apart, rather than every det_step frames
+    pipelined - if True, detection runs concurrently with tracking, see tracking_pipeline
+    detector - (optional) detector to use, e.g. a running Detector_Process
+    """
+    
+    init_frames = 3
+    scheduler = None
+    if adaptive:
+        scheduler = Detection_Scheduler(min_interval = init_frames,max_interval = 2*det_step,
+                                        init_frames = init_frames)
+    trk = Tracker(tracker, detector = detector, det_step = det_step, srr = srr, ber = ber, 
+                  init_frames = init_frames, PLOT = PLOT, 
+                  localizer_checkpoint = localizer_checkpoint, scheduler = scheduler)
+         
+    # Loop Setup, frames are decoded in the background as tracking proceeds
+    if is_video(track_path):
+        frames = Video_Source(track_path)
+    elif cache_root is not None:
+        frames = Cached_Sequence_Source(track_path,cache_root)
+    else:
+        frames = Image_Directory_Source(track_path)
+    
+    # 3. Main Loop, consecutive detector frames are read ahead and detected in one batch
+    if pipelined:
+        final_output = track_pipelined(trk,frames)
+    else:
+        frames_iter = iter(frames)
+        for frame in frames_iter:
+            n_burst = trk.detection_burst()
+            if n_burst > 1:
+                burst = [frame] + list(itertools.islice(frames_iter,n_burst - 1))
+                for frame in trk.detect_ahead(burst):
+                    trk.step(frame)
+            else:
+                trk.step(frame)
+        final_output = trk.flush()
+    time_metrics = trk.time_metrics
+    total_time = sum(time_metrics.values())
+    
+    # frames actually tracked, container frame counts (e.g. of VFR video) can be wrong
+    n_frames = trk.frame_num
     
     if False:
         print("Finished file {} for det_step {}".format(track_path,det_step))
         print("\n\nTotal Framerate: {:.2f} fps".format(n_frames/total_time))
+        if hasattr(frames,"stats"):
+            print("Frame decode: {:.2f} fps ({:.2f}s stalled)".format(frames.stats()["fps"],frames.stats()["stall_time"]))
         print("---------- per operation ----------")
         for key in time_metrics:
             print("{:.3f}s ({:.2f}%) on {}".format(time_metrics[key],time_metrics[key]/total_time*100,key))
-
-
-    #write final output 
-        
-    final_output = []
-    for frame in range(n_frames):
-        frame_objs = []
-        
-        for id in all_tracks:
-            bbox = all_tracks[id][frame]
-            if bbox[0] != 0:
-                obj_dict = {}
-                obj_dict["id"] = id
-                obj_dict["class_num"] = np.argmax(all_classes[id])
-                x0 = bbox[0] - bbox[2]/2.0
-                x1 = bbox[0] + bbox[2]/2.0
-                y0 = bbox[1] - bbox[2]*bbox[3]/2.0
-                y1 = bbox[1] + bbox[2]*bbox[3]/2.0
-                obj_dict["bbox"] = np.array([x0,y0,x1,y1])
-                
-                frame_objs.append(obj_dict)
-        
-        final_output.append(frame_objs)
+        for key in trk.overlapped_metrics:
+            print("{:.3f}s on {} (overlapped with tracking)".format(trk.overlapped_metrics[key],key))
+        if scheduler is not None:
+            print("Detection bursts by reason: {}".format(scheduler.summary()))
         
     return final_output, n_frames/total_time, time_metrics
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pipelined tracking. Frames flow through two concurrent stages joined by a
+bounded queue: a detection stage pulls decoded frames from the frame source
+(which decodes ahead on its own workers) and runs the detector, one batch per
+scheduled burst, while the tracking stage runs prediction, localization,
+matching and Kalman filter updates on earlier frames. Detector output depends
+only on the frame, so each frame is tracked exactly as it would be
+sequentially, in order, with the same results.
+"""
+
+import time
+import queue
+import threading
+import itertools
+
+from frame_sources import Frame
+
+
+class Detection_Stage(object):
+    """
+    Thread that reads frames ahead of the tracker and detects scheduled frames.
+    Items (frame, detections or None) are put on a queue of at most queue_depth
+    frames, followed by None once frames are exhausted
+    """
+
+    def __init__(self,tracker,frames,queue_depth = 4):
+        """
+        tracker - Tracker whose detector and (fixed) detection schedule are used
+        frames - iterable of Frames, tracked from tracker.frame_num on
+        queue_depth - most frames read ahead of the tracker
+        """
+        self.tracker = tracker
+        self.frames = frames
+        self.queue = queue.Queue(maxsize = max(1,queue_depth))
+        self.stop = threading.Event()
+        self.error = None
+        self.detect_time = 0 # seconds spent in the detector, overlapped with tracking
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self._run,daemon = True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        """
+        Stops the stage, unblocking it if the queue is full
+        """
+        self.stop.set()
+        while self.thread is not None and self.thread.is_alive():
+            try:
+                self.queue.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+        self.thread = None
+
+    def _put(self,item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item,timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            frame_num = self.tracker.frame_num
+            frames_iter = iter(self.frames)
+            for frame in frames_iter:
+                n_burst = self.tracker.detection_burst(frame_num)
+                burst = [frame] + list(itertools.islice(frames_iter,max(0,n_burst - 1)))
+                burst = [f if isinstance(f,Frame) else Frame(f,frame_num + i) for i,f in enumerate(burst)]
+
+                detections = [None] * len(burst)
+                if n_burst > 0:
+                    start = time.time()
+                    detections = self.tracker.detect_batch(burst)
+                    self.detect_time += time.time() - start
+
+                for item in zip(burst,detections):
+                    if not self._put(item):
+                        return
+                frame_num += len(burst)
+        except Exception as e:
+            # re-raised in the tracking stage
+            self.error = e
+        finally:
+            self._put(None)
+
+    def __iter__(self):
+        """
+        Yields (frame, detections) in frame order
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+
+def track_pipelined(tracker,frames,queue_depth = 4):
+    """
+    Tracks all frames, detecting frames on a separate stage concurrently with
+    tracking of earlier frames
+    tracker - Tracker; frames not known ahead of time to be detector frames
+              (e.g. chosen by a Detection_Scheduler) are detected when stepped
+    frames - iterable of Frames or H x W x 3 uint8 RGB arrays
+    queue_depth - most frames decoded and detected ahead of the tracker
+    returns - tracked objects for each frame, as from Tracker.flush(). Detector
+              time on the detection stage is added to tracker.overlapped_metrics
+    """
+    tm = tracker.time_metrics
+    stage = Detection_Stage(tracker,frames,queue_depth = queue_depth).start()
+    try:
+        items = iter(stage)
+        while True:
+            start = time.time()
+            item = next(items,None)
+            tm['pipeline wait'] += time.time() - start
+            if item is None:
+                break
+
+            frame,detections = item
+            if detections is not None:
+                tracker.pending_detections[tracker.frame_num] = detections
+            tracker.step(frame)
+    finally:
+        stage.close()
+        tracker.overlapped_metrics['detect'] += stage.detect_time
+    return tracker.flush()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar append-only log of tracked object states. Each observation is one
+(frame, id, state) row, appended frame by frame, with the index of the first
+row of every frame kept in an offsets list. Memory scales with the number of
+actual observations rather than objects x sequence length, and building the
+per-frame output is a single linear pass over the rows.
+"""
+
+import numpy as np
+
+
+class Trajectory_Store(object):
+    def __init__(self,state_size = 7,capacity = 1024,first_frame = 0):
+        self.state_size = state_size
+        self.first_frame = first_frame      # frame number of first frame stored
+        self.n = 0                          # number of rows stored
+
+        # column storage, grown geometrically as rows are appended
+        self.frames = np.zeros(capacity,dtype = np.int64)
+        self.ids    = np.zeros(capacity,dtype = np.int64)
+        self.states = np.zeros([capacity,state_size],dtype = np.float32)
+
+        # offsets[f] stores index of first row belonging to frame first_frame + f
+        self.offsets = []
+
+    def __len__(self):
+        return self.n
+
+    def _reserve(self,n_new):
+        capacity = len(self.ids)
+        if self.n + n_new <= capacity:
+            return
+        while capacity < self.n + n_new:
+            capacity *= 2
+        self.frames = np.resize(self.frames,capacity)
+        self.ids    = np.resize(self.ids,capacity)
+        self.states = np.resize(self.states,[capacity,self.state_size])
+
+    def append(self,frame_num,obj_ids,states):
+        """
+        Stores states of all objects tracked in frame frame_num. Frames must be
+        appended in nondecreasing order
+        frame_num - int frame index
+        obj_ids - list of length n of object ids
+        states - n x (>= state_size) array of object states
+        """
+        frame_num = frame_num - self.first_frame
+        assert 0 <= frame_num and len(self.offsets) <= frame_num + 1, "Frames must be appended in order"
+        # frames with no rows (skipped or empty) start where the next frame does
+        while len(self.offsets) <= frame_num:
+            self.offsets.append(self.n)
+
+        n_new = len(obj_ids)
+        if n_new == 0:
+            return
+        self._reserve(n_new)
+        self.frames[self.n:self.n+n_new] = frame_num + self.first_frame
+        self.ids[self.n:self.n+n_new]    = obj_ids
+        self.states[self.n:self.n+n_new] = np.asarray(states)[:,:self.state_size]
+        self.n += n_new
+
+    def _rows(self,frame):
+        """
+        Returns (start,end) row range for frame first_frame + frame
+        """
+        if frame < 0 or frame >= len(self.offsets):
+            return self.n,self.n
+        end = self.offsets[frame+1] if frame + 1 < len(self.offsets) else self.n
+        return self.offsets[frame],end
+
+    def frame(self,frame_num):
+        """
+        Returns (ids, states) views of all rows stored for frame frame_num
+        """
+        start,end = self._rows(frame_num - self.first_frame)
+        return self.ids[start:end],self.states[start:end]
+
+    def to_output(self,n_frames,classes):
+        """
+        Builds one list of object dicts (fields id, class_num, bbox (x0,y0,x1,y1))
+        per frame, as expected by mot_eval.evaluate_mot
+        n_frames - total number of frames stored, starting from first_frame
+        classes - dict of class index keyed by object id
+        """
+        # convert xysr to xyxy for all rows at once
+        s = self.states[:self.n]
+        bboxes = np.stack((s[:,0] - s[:,2]/2.0,
+                           s[:,1] - s[:,2]*s[:,3]/2.0,
+                           s[:,0] + s[:,2]/2.0,
+                           s[:,1] + s[:,2]*s[:,3]/2.0),axis = 1).astype(float)
+
+        final_output = []
+        for frame in range(n_frames):
+            frame_objs = []
+            start,end = self._rows(frame)
+            for row in range(start,end):
+                id = int(self.ids[row])
+                frame_objs.append({"id":id,
+                                   "class_num":classes[id],
+                                   "bbox":bboxes[row]})
+            final_output.append(frame_objs)
+        return final_output